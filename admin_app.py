@@ -0,0 +1,316 @@
+# admin_app.py
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from urllib.parse import quote, unquote
+
+import jinja2
+from aiohttp import web
+
+from settings import SECRET_KEY, USER_NAME, USER_PASSWORD
+
+SESSION_COOKIE = 'admin_session'
+FLASH_COOKIE = 'admin_flash'
+SESSION_LIFETIME = 7 * 86400
+SUBSCRIPTIONS_PER_PAGE = 50
+
+from broadcasts import notify_job_created
+from key_pool import provision_key
+from outbound import send_message as queue_message
+from traffic import usage_since
+from vpn_manager import get_manager
+from db import (
+    create_broadcast_job,
+    get_broadcast_job,
+    get_recent_broadcast_jobs,
+    get_subscriptions_page,
+    get_traffic_usage,
+    SUBSCRIPTION_SORTS,
+    delete_subscription_async,
+    update_subscription_async,
+    get_subscription_expiry_async
+)
+
+routes = web.RouteTableDef()
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+    autoescape=jinja2.select_autoescape(['html'])
+)
+
+
+def _sign(value):
+    return hmac.new(SECRET_KEY.encode(), value.encode(), hashlib.sha256).hexdigest()
+
+
+def _is_logged_in(request):
+    if not SECRET_KEY:
+        # With an empty key anyone could compute a valid signature
+        return False
+    cookie = request.cookies.get(SESSION_COOKIE, '')
+    expires, _, signature = cookie.partition(':')
+    if not expires.isdigit() or not hmac.compare_digest(_sign(f"admin:{expires}").encode(), signature.encode()):
+        return False
+    return int(expires) > time.time()
+
+
+def url_for(request, name, **params):
+    return str(request.app.router[name].url_for(**{key: str(value) for key, value in params.items()}))
+
+
+def flash(response, message):
+    # Сообщение хранится в cookie до следующего отображения страницы; новое заменяет прежнее
+    response.set_cookie(FLASH_COOKIE, quote(json.dumps([message])), httponly=True, samesite='Lax')
+
+
+def redirect(request, name, message=None, **params):
+    response = web.HTTPFound(url_for(request, name, **params))
+    if message:
+        flash(response, message)
+    return response
+
+
+def render_template(request, template_name, **context):
+    flashed = []
+    if FLASH_COOKIE in request.cookies:
+        try:
+            flashed = json.loads(unquote(request.cookies[FLASH_COOKIE]))
+        except ValueError:
+            pass
+    html = templates.get_template(template_name).render(
+        url_for=functools.partial(url_for, request),
+        get_flashed_messages=lambda: flashed,
+        **context
+    )
+    response = web.Response(text=html, content_type='text/html')
+    if flashed:
+        response.del_cookie(FLASH_COOKIE)
+    return response
+
+
+def login_required(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        if not _is_logged_in(request):
+            raise web.HTTPFound(f"{url_for(request, 'admin.login')}?next={quote(request.path_qs)}")
+        return await handler(request)
+    return wrapper
+
+
+@routes.route('*', '/admin/login', name='admin.login')
+async def login(request):
+    if request.method == 'POST':
+        form = await request.post()
+        username = form.get('username', '')
+        password = form.get('password', '')
+        # compare_digest accepts only ASCII str, so credentials are compared as UTF-8 bytes
+        if (USER_NAME and USER_PASSWORD and SECRET_KEY
+                and hmac.compare_digest(username.encode(), USER_NAME.encode())
+                and hmac.compare_digest(password.encode(), USER_PASSWORD.encode())):
+            next_page = request.query.get('next', '')
+            if not next_page.startswith('/') or next_page.startswith('//'):
+                next_page = url_for(request, 'admin.subscriptions_page')  # Редирект либо на нужную страницу, либо на subscriptions
+            response = web.HTTPFound(next_page)
+            expires = int(time.time()) + SESSION_LIFETIME
+            response.set_cookie(SESSION_COOKIE, f"{expires}:{_sign(f'admin:{expires}')}",
+                                max_age=SESSION_LIFETIME, httponly=True, samesite='Lax')
+            raise response
+        else:
+            raise redirect(request, 'admin.login', 'Invalid credentials')
+    return render_template(request, 'login.html')
+
+
+@routes.route('*', '/admin/broadcast', name='admin.broadcast_message')
+@login_required
+async def broadcast_message(request):
+    if request.method == 'POST':
+        form = await request.post()
+        message = form['message']
+        segment = form.get('segment', 'all')
+        days = int(form['days']) if form.get('days', '').isdigit() else None
+
+        # Рассылку выполняет фоновый обработчик
+        job_id = await create_broadcast_job(message, segment, days)
+        notify_job_created()
+
+        raise redirect(request, 'admin.broadcast_progress', f'Рассылка {job_id} поставлена в очередь.', job_id=job_id)
+
+    jobs = await get_recent_broadcast_jobs()
+    return render_template(request, 'broadcast.html', jobs=jobs)
+
+
+@routes.get(r'/admin/broadcast/{job_id:\d+}', name='admin.broadcast_progress')
+@login_required
+async def broadcast_progress(request):
+    job_id = int(request.match_info['job_id'])
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        raise redirect(request, 'admin.broadcast_message', f'Broadcast {job_id} not found')
+    return render_template(request, 'broadcast_job.html', job=job)
+
+
+# Форма для отправки сообщения
+@routes.route('*', '/admin/send_message', name='admin.send_message')
+@login_required
+async def send_message(request):
+    if request.method == 'POST':
+        form = await request.post()
+        chat_id = form['chat_id']
+        message_text = form['message']
+
+        try:
+            await queue_message(chat_id, message_text)
+            logging.info("Сообщение отправлено пользователю %s: %s", chat_id, message_text, extra={'user_id': chat_id})
+        except Exception as e:
+            logging.error("Ошибка при отправке сообщения пользователю %s: %s", chat_id, e)
+            raise redirect(request, 'admin.send_message', f"Ошибка при отправке сообщения пользователю {chat_id}")
+        raise redirect(request, 'admin.send_message', f"Сообщение отправлено пользователю {chat_id}")
+
+    return render_template(request, 'send_message.html')
+
+
+# Выход
+@routes.get('/admin/logout', name='admin.logout')
+@login_required
+async def logout(request):
+    response = web.HTTPFound(url_for(request, 'admin.login'))
+    response.del_cookie(SESSION_COOKIE)
+    raise response
+
+
+def _parse_cursor(value):
+    # Cursor is "<sort value>:<id>" of the first or last row on a page
+    sort_value, _, sub_id = (value or '').rpartition(':')
+    try:
+        return int(sort_value), int(sub_id)
+    except ValueError:
+        return None
+
+
+@routes.get('/admin/subscriptions', name='admin.subscriptions_page')
+@login_required
+async def subscriptions_page(request):
+    started = time.perf_counter()
+    query = request.query
+    filters = {
+        'sort': query.get('sort') if query.get('sort') in SUBSCRIPTION_SORTS else 'id',
+        'order': 'desc' if query.get('order') == 'desc' else 'asc',
+        'user_id': query.get('user_id', '').strip(),
+        'key_id': query.get('key_id', '').strip(),
+        'status': query.get('status') if query.get('status') in ('expiring', 'expired') else '',
+        'days': query.get('days', '').strip() or '5',
+    }
+    after = _parse_cursor(query.get('after'))
+    before = None if after else _parse_cursor(query.get('before'))
+    subscriptions, has_more = await get_subscriptions_page(
+        sort=filters['sort'],
+        descending=filters['order'] == 'desc',
+        after=after,
+        before=before,
+        user_id=int(filters['user_id']) if filters['user_id'].isdigit() else None,
+        key_id=filters['key_id'] or None,
+        status=filters['status'] or None,
+        days=int(filters['days']) if filters['days'].isdigit() else 0,
+        limit=SUBSCRIPTIONS_PER_PAGE
+    )
+    usage = await get_traffic_usage([sub['id'] for sub in subscriptions], usage_since())
+    db_time = time.perf_counter() - started
+
+    page_url = request.app.router['admin.subscriptions_page'].url_for()
+    active_filters = {name: value for name, value in filters.items() if value}
+
+    def link(**params):
+        return str(page_url.with_query({**active_filters, **params}))
+
+    def sort_link(sort):
+        order = 'desc' if filters['sort'] == sort and filters['order'] == 'asc' else 'asc'
+        return link(sort=sort, order=order)
+
+    def cursor(sub):
+        value = sub['expires_at_ts'] if filters['sort'] == 'expires_at' else sub[filters['sort']]
+        return f"{value}:{sub['id']}"
+
+    has_prev = has_more if before else after is not None
+    has_next = True if before else has_more
+    render_started = time.perf_counter()
+    response = render_template(
+        request, 'index.html',
+        subscriptions=subscriptions,
+        usage=usage,
+        filters=filters,
+        sort_link=sort_link,
+        prev_url=link(before=cursor(subscriptions[0])) if has_prev and subscriptions else None,
+        next_url=link(after=cursor(subscriptions[-1])) if has_next and subscriptions else None,
+        first_url=link(),
+        db_time_ms=round(db_time * 1000, 1)
+    )
+    render_time = time.perf_counter() - render_started
+    response.headers['Server-Timing'] = f"db;dur={db_time * 1000:.1f}, render;dur={render_time * 1000:.1f}"
+    return response
+
+
+@routes.post(r'/admin/delete/{sub_id:\d+}', name='admin.delete_subscription_route')
+@login_required
+async def delete_subscription_route(request):
+    sub_id = int(request.match_info['sub_id'])
+    deleted = await delete_subscription_async(sub_id)
+    if deleted is None:
+        raise redirect(request, 'admin.subscriptions_page', f'Subscription {sub_id} not found')
+    server, key_id = deleted
+    try:
+        await get_manager().delete_key(server, key_id)
+    except Exception as e:
+        # sync_keys removes the orphaned key later
+        logging.error("Error deleting key %s on %s: %s", key_id, server, e)
+        raise redirect(request, 'admin.subscriptions_page',
+                       f'Subscription {sub_id} deleted, key {key_id} on {server} is left for sync')
+    raise redirect(request, 'admin.subscriptions_page', f'Subscription {sub_id} deleted')
+
+
+@routes.route('*', '/admin/create', name='admin.create_key')
+@login_required
+async def create_key(request):
+    if request.method == 'POST':
+        form = await request.post()
+        try:
+            user_id = int(form.get('user_id', ''))
+            duration_days = int(form.get('duration', ''))
+        except ValueError:
+            raise redirect(request, 'admin.create_key', 'User ID and duration must be whole numbers')
+        if duration_days <= 0:
+            raise redirect(request, 'admin.create_key', f'Invalid duration: {duration_days}')
+        server = form.get('server') if form.get('server') in get_manager().names else None
+        key_data = await provision_key(user_id, duration_days, server=server)
+        if key_data:
+            message = f"Key for user {user_id} created on {key_data['server']}"
+        else:
+            message = "Error creating key"
+        raise redirect(request, 'admin.subscriptions_page', message)
+    return render_template(request, 'new_key.html', servers=get_manager().names)
+
+
+@routes.route('*', r'/admin/edit/{sub_id:\d+}', name='admin.edit_subscription')
+@login_required
+async def edit_subscription(request):
+    sub_id = int(request.match_info['sub_id'])
+    if request.method == 'POST':
+        form = await request.post()
+        new_expires_at = form['expires_at']
+        try:
+            await update_subscription_async(sub_id, new_expires_at)
+        except ValueError:
+            raise redirect(request, 'admin.edit_subscription', f'Invalid date: {new_expires_at}', sub_id=sub_id)
+        raise redirect(request, 'admin.subscriptions_page', f'Subscription {sub_id} updated')
+    else:
+        expires_at = await get_subscription_expiry_async(sub_id)
+        return render_template(request, 'edit.html', sub_id=sub_id, expires_at=expires_at)
+
+
+def setup_admin(app):
+    if not SECRET_KEY:
+        logging.warning("SECRET_KEY is not set, the admin panel is not mounted")
+        return
+    app.add_routes(routes)
@@ -0,0 +1,384 @@
+# bench/run.py
+"""End-to-end load benchmark for the bot.
+
+Synthetic updates are fed straight into the bot's dispatcher. Telegram is replaced by a bot
+session that records API calls, and Outline by outline_emulator. Every run starts from
+a fresh SQLite database seeded with the requested number of subscriptions, and the
+emulator holds a key for each of them.
+
+    python bench/run.py --sizes 1000,10000,100000 --concurrency 50 --updates 5000
+    python bench/run.py --outline-latency 'lognormal:0.2,0.8' --outline-error-rate 0.05
+    python bench/run.py --output new.json --compare bench/results/old.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from outline_emulator import OutlineEmulator
+
+BOT_TOKEN = '123456:BENCHMARK'
+SEED_USER_BASE = 10_000_000  # Seeded users have ids from here up
+NEW_USER_BASE = 50_000_000  # Users first seen during the run
+SUBSCRIPTIONS_PER_USER = 2
+
+# Scenario -> relative weight in the default mix
+SCENARIOS = {
+    'start': 25,
+    'my_keys': 30,
+    'buy_new_key': 10,
+    'new_subscribe': 10,
+    'renew_subscription': 10,
+    'renew_period': 5,
+    'test_vpn': 10,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma-separated numbers of seeded subscriptions, one run each")
+    parser.add_argument('--concurrency', type=int, default=50, help="updates processed at the same time")
+    parser.add_argument('--updates', type=int, default=5000, help="measured updates per run")
+    parser.add_argument('--warmup', type=int, default=200, help="updates processed before measuring")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma-separated subset of scenarios")
+    parser.add_argument('--outline-latency', default='fixed:0.05',
+                        help="latency distribution of every Outline call, see outline_emulator.parse_latency")
+    parser.add_argument('--outline-error-rate', type=float, default=0.0, help="share of Outline calls failing")
+    parser.add_argument('--outline-rate-limit', type=float, help="Outline requests per second before 429")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="keep the outbound rate limits instead of lifting them")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON results file (default bench/results/<time>.json)")
+    parser.add_argument('--compare', help="earlier results file to print the difference against")
+    return parser.parse_args()
+
+
+def configure_environment(args, outline):
+    os.environ['TELEGRAM_BOT_TOKEN'] = BOT_TOKEN
+    os.environ['OUTLINE_API'] = outline.url
+    os.environ.pop('OUTLINE_SERVERS', None)
+    os.environ.setdefault('YOOMONEY_WALLET', '4100000000000000')
+    os.environ.setdefault('NOTIFICATION_URL', 'https://example.com/yoomoney_notification')
+    if not args.telegram_limits:
+        for name in ('OUTBOUND_GLOBAL_RATE', 'OUTBOUND_CHAT_RATE', 'OUTBOUND_CHAT_BURST'):
+            os.environ[name] = '1000000'
+    logging.basicConfig(level=logging.ERROR)
+
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+    from aiogram.types import Chat, Message
+
+    class RecordingSession(BaseSession):
+        """Bot session that answers every API call locally and counts them by method."""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self._message_ids = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            if isinstance(method, SendMessage):
+                self._message_ids += 1
+                return Message(message_id=self._message_ids, date=datetime.now(timezone.utc),
+                               chat=Chat(id=method.chat_id, type='private'), text=method.text)
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b''
+
+        async def close(self):
+            pass
+
+    return RecordingSession
+
+
+def start_outline(args):
+    return OutlineEmulator(
+        latency={'*': args.outline_latency},
+        error_rates={'*': args.outline_error_rate},
+        rate_limits={'*': args.outline_rate_limit} if args.outline_rate_limit else None,
+        random_seed=args.seed,
+    ).start()
+
+
+def seed_database(path, size):
+    """Bulk insert users and subscriptions into a database created by init_db."""
+    now_ts = int(time.time())
+    users = max(1, size // SUBSCRIPTIONS_PER_USER)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, first_interaction) VALUES (?, ?)',
+                         ((SEED_USER_BASE + i, '2024-01-01T00:00:00+00:00') for i in range(users)))
+        rows = []
+        for sub_id in range(1, size + 1):
+            # A tenth of the subscriptions has expired, the rest run for up to 180 days
+            expires_at_ts = now_ts + random.randint(-30 * 86400, -3600) if sub_id % 10 == 0 else \
+                now_ts + random.randint(3600, 180 * 86400)
+            expires_at = datetime.fromtimestamp(expires_at_ts, timezone.utc).isoformat()
+            rows.append((sub_id, SEED_USER_BASE + (sub_id - 1) % users, str(sub_id),
+                         f'ss://seeded{sub_id}@127.0.0.1:12345/?outline=1', expires_at, expires_at_ts, 'default'))
+        conn.executemany('INSERT INTO subscriptions (id, user_id, key_id, access_url, expires_at, expires_at_ts, server) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.close()
+    return users
+
+
+class UpdateFactory:
+    def __init__(self, users, size, scenarios):
+        self.users = users
+        self.size = size
+        self.scenarios = scenarios
+        self.weights = [SCENARIOS[name] for name in scenarios]
+        self.update_id = 0
+        self.new_users = 0
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def _message(self, user_id, text, entities=None):
+        message = {'message_id': self.update_id, 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text}
+        if entities:
+            message['entities'] = entities
+        return message
+
+    def _callback(self, user_id, data):
+        return {
+            'id': str(self.update_id), 'from': self._user(user_id), 'chat_instance': 'bench', 'data': data,
+            'message': self._message(user_id, 'menu'),
+        }
+
+    def _seeded_user(self):
+        return SEED_USER_BASE + random.randrange(self.users)
+
+    def _new_user(self):
+        self.new_users += 1
+        return NEW_USER_BASE + self.new_users
+
+    def next(self):
+        from aiogram.types import Update
+        self.update_id += 1
+        scenario = random.choices(self.scenarios, self.weights)[0]
+        if scenario == 'start':
+            user_id = self._seeded_user() if random.random() < 0.8 else self._new_user()
+            payload = {'message': self._message(user_id, '/start', [{'type': 'bot_command', 'offset': 0, 'length': 6}])}
+        elif scenario == 'my_keys':
+            payload = {'callback_query': self._callback(self._seeded_user(), 'my_keys')}
+        elif scenario == 'buy_new_key':
+            payload = {'callback_query': self._callback(self._seeded_user(), 'buy_new_key')}
+        elif scenario == 'new_subscribe':
+            payload = {'callback_query': self._callback(self._seeded_user(),
+                                                        f"new_subscribe_{random.choice((30, 90, 180))}")}
+        elif scenario == 'renew_subscription':
+            payload = {'callback_query': self._callback(self._seeded_user(), 'renew_subscription')}
+        elif scenario == 'renew_period':
+            sub_id = random.randint(1, max(1, self.size))
+            user_id = SEED_USER_BASE + (sub_id - 1) % self.users
+            payload = {'callback_query': self._callback(user_id, f"renew_{sub_id}_{random.choice((30, 90, 180))}")}
+        else:
+            # A trial key is given once per user, so every trial comes from a new user
+            payload = {'callback_query': self._callback(self._new_user(), 'test_vpn')}
+        return scenario, Update.model_validate({'update_id': self.update_id, **payload})
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3) if samples else 0.0,
+    }
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def db_totals(db):
+    totals = defaultdict(lambda: [0, 0.0])
+    for (function, mode), (count, seconds) in db.db_query_seconds.totals().items():
+        totals[function][0] += count
+        totals[function][1] += seconds
+    return totals
+
+
+async def run_size(args, size, session_class, workdir, outline):
+    import db
+    import outbound
+    from aiogram import Bot
+    from telegram_bot import get_dispatcher
+
+    path = os.path.join(workdir, f'bench-{size}.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.DB_FILE = path
+    db._user_cache.clear()
+    await db.init_db()
+    await db.close_db()
+    seed_started = time.perf_counter()
+    users = seed_database(path, size)
+    # Seeded subscription i holds Outline key i
+    outline.reset(seed_keys=size)
+    seed_seconds = time.perf_counter() - seed_started
+
+    dp = get_dispatcher()
+    session = session_class()
+    bot = Bot(token=BOT_TOKEN, session=session)
+    outbound.dispatcher.start(bot)
+    factory = UpdateFactory(users, size, args.scenarios.split(','))
+    latencies = defaultdict(list)
+    errors = Counter()
+
+    async def process(count, record):
+        for _ in range(count):
+            scenario, update = factory.next()
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors[f"{scenario}: {type(e).__name__}"] += 1
+            if record:
+                latencies[scenario].append(time.perf_counter() - started)
+
+    async def run_workers(total, record):
+        per_worker, extra = divmod(total, args.concurrency)
+        await asyncio.gather(*(process(per_worker + (i < extra), record) for i in range(args.concurrency)))
+
+    try:
+        await run_workers(args.warmup, record=False)
+        db_before = db_totals(db)
+        session.calls.clear()
+        lag_samples = []
+        lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+        started = time.perf_counter()
+        await run_workers(args.updates, record=True)
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        db_after = db_totals(db)
+    finally:
+        await outbound.dispatcher.stop()
+        await db.close_db()
+        await bot.session.close()
+
+    db_time = {}
+    for function, (count, seconds) in db_after.items():
+        before_count, before_seconds = db_before.get(function, (0, 0.0))
+        if count > before_count:
+            db_time[function] = {'calls': count - before_count,
+                                 'total_ms': round((seconds - before_seconds) * 1000, 3)}
+    return {
+        'subscriptions': size,
+        'users': users,
+        'seed_seconds': round(seed_seconds, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_per_second': round(args.updates / elapsed, 1),
+        'latency': {'all': summarize([s for values in latencies.values() for s in values]),
+                    **{scenario: summarize(values) for scenario, values in sorted(latencies.items())}},
+        'db': {'total_ms': round(sum(item['total_ms'] for item in db_time.values()), 3),
+               'functions': dict(sorted(db_time.items(), key=lambda item: -item[1]['total_ms']))},
+        'loop_lag': summarize(lag_samples),
+        'telegram_calls': dict(session.calls),
+        'outline_calls': outline.stats,
+        'errors': dict(errors),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(run):
+    print(f"\n{run['subscriptions']} subscriptions: {run['throughput_per_second']} updates/s, "
+          f"db {run['db']['total_ms']} ms, loop lag p99 {run['loop_lag']['p99_ms']} ms")
+    for scenario, stats in run['latency'].items():
+        print(f"  {scenario:<20} n={stats['count']:<6} p50={stats['p50_ms']:<9} "
+              f"p95={stats['p95_ms']:<9} p99={stats['p99_ms']}")
+    if run['errors']:
+        print(f"  errors: {run['errors']}")
+
+
+def print_comparison(current, baseline):
+    previous = {run['subscriptions']: run for run in baseline['runs']}
+    print(f"\nCompared with {baseline.get('revision')} ({baseline.get('started_at')}):")
+    for run in current['runs']:
+        old = previous.get(run['subscriptions'])
+        if old is None:
+            continue
+        change = (run['throughput_per_second'] / old['throughput_per_second'] - 1) * 100
+        print(f"  {run['subscriptions']} subscriptions: throughput {change:+.1f}%")
+        for scenario, stats in run['latency'].items():
+            old_stats = old['latency'].get(scenario)
+            if old_stats and old_stats['p95_ms']:
+                print(f"    {scenario:<20} p95 {(stats['p95_ms'] / old_stats['p95_ms'] - 1) * 100:+.1f}%")
+
+
+async def main():
+    args = parse_args()
+    random.seed(args.seed)
+    outline = start_outline(args)
+    configure_environment(args, outline)
+    session_class = make_session_class()
+    result = {
+        'revision': git_revision(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'runs': [],
+    }
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in (int(size) for size in args.sizes.split(',')):
+                run = await run_size(args, size, session_class, workdir, outline)
+                result['runs'].append(run)
+                print_run(run)
+    finally:
+        from vpn_manager import close_manager
+        await close_manager()
+        outline.stop()
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"\nResults saved to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(result, json.load(f))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
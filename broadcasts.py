@@ -0,0 +1,83 @@
+# broadcasts.py
+import asyncio
+import logging
+import os
+
+from db import (
+    checkpoint_broadcast_batch,
+    count_audience,
+    finish_broadcast_job,
+    get_audience_batch,
+    get_next_broadcast_job,
+    get_pending_deliveries,
+    record_broadcast_results,
+    start_broadcast_job
+)
+from outbound import send_message
+
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))  # Recipients read and checkpointed at once
+BROADCAST_POLL_INTERVAL = 5  # Seconds between checks for new jobs created by the admin panel
+
+_job_created = asyncio.Event()
+
+
+def notify_job_created():
+    """Wake the worker right away instead of waiting for the next poll."""
+    _job_created.set()
+
+
+async def _deliver(job, user_ids):
+    futures = [send_message(user_id, job['message'], bulk=True) for user_id in user_ids]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    await record_broadcast_results(job['id'], [
+        (user_id, str(result) if isinstance(result, Exception) else None)
+        for user_id, result in zip(user_ids, results)
+    ])
+
+
+async def run_broadcast_job(job):
+    job_id = job['id']
+    total = await count_audience(job['segment'], job['segment_days'])
+    await start_broadcast_job(job_id, total)
+    logging.info("Рассылка %s запущена, получателей: %s", job_id, total, extra={'job_id': job_id})
+
+    # Получатели, отметка о доставке которым не была сохранена до перезапуска
+    pending = await get_pending_deliveries(job_id)
+    if pending:
+        logging.info("Рассылка %s: повторная отправка %s получателям после перезапуска", job_id, len(pending))
+        await _deliver(job, pending)
+
+    cursor_user_id = job['cursor_user_id']
+    while True:
+        user_ids = await get_audience_batch(job['segment'], cursor_user_id, BROADCAST_BATCH_SIZE,
+                                            job['segment_days'])
+        if not user_ids:
+            break
+        await checkpoint_broadcast_batch(job_id, user_ids)
+        cursor_user_id = user_ids[-1]
+        await _deliver(job, user_ids)
+
+    await finish_broadcast_job(job_id)
+    logging.info("Рассылка %s завершена", job_id, extra={'job_id': job_id})
+
+
+async def run_broadcast_worker():
+    while True:
+        job = None
+        try:
+            job = await get_next_broadcast_job()
+            if job is not None:
+                await run_broadcast_job(job)
+                continue
+        except Exception as e:
+            logging.error("Ошибка при выполнении рассылки: %s", e)
+            if job is not None:
+                try:
+                    await finish_broadcast_job(job['id'], status='failed')
+                except Exception as finish_exception:
+                    logging.error("Не удалось отметить рассылку %s как неудачную: %s", job['id'], finish_exception)
+        _job_created.clear()
+        try:
+            await asyncio.wait_for(_job_created.wait(), timeout=BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
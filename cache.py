@@ -0,0 +1,63 @@
+# cache.py
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ttl seconds.
+
+    Writers call invalidate(); a reader that loaded a value from the database stores it
+    with set(key, value, generation) using the generation taken before the load, so a
+    value read before a concurrent invalidation is dropped instead of cached.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self._stats['misses'] += 1
+            return default
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self._stats['expired'] += 1
+            self._stats['misses'] += 1
+            return default
+        self._data.move_to_end(key)
+        self._stats['hits'] += 1
+        return value
+
+    def set(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def invalidate(self, *keys):
+        self.generation += 1
+        for key in keys:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self):
+        lookups = self._stats['hits'] + self._stats['misses']
+        return {
+            **self._stats,
+            'size': len(self._data),
+            'hit_ratio': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+        }
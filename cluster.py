@@ -0,0 +1,396 @@
+# cluster.py
+"""Telegram updates handled by several worker processes.
+
+The main process is the ingress: it receives the webhook and forwards each update over
+a unix socket to worker user_id % CLUSTER_WORKERS, so one user's updates always reach
+the same worker in order. Workers run the aiogram dispatcher. Background jobs
+(expiry, key sync, pool, broadcasts, traffic, payments) run only in the process that
+holds the lease in the shared SQLite database.
+
+Messages on a socket are JSON objects preceded by their 4-byte length:
+    ingress -> worker: {"update": {...}}, {"invalidate": [user_id, ...]}
+    worker -> ingress: {"subscription": [sub_id, expires_at_ts]}, {"refill": true}
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import struct
+import sys
+import tempfile
+from collections import deque
+
+from aiohttp import web
+from aiogram.methods import TelegramMethod
+
+from db import (
+    acquire_lease,
+    add_invalidation_listener,
+    add_subscription_listener,
+    close_db,
+    forget_subscriptions,
+    init_db,
+    notify_subscription_changed,
+    release_lease,
+    remove_subscription_listener
+)
+from key_pool import add_refill_listener, remove_refill_listener, request_refill
+from loop_monitor import LOOP_MONITOR, create_task, monitor as loop_monitor
+from outbound import OUTBOUND_GLOBAL_RATE, dispatcher as outbound_dispatcher
+from telegram_webhook import (
+    TELEGRAM_MAX_IN_FLIGHT,
+    TELEGRAM_SHUTDOWN_TIMEOUT,
+    TELEGRAM_WEBHOOK_PATH,
+    TELEGRAM_WEBHOOK_SECRET
+)
+
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', '0'))  # Update worker processes; 0 handles updates in-process
+CLUSTER_SOCKET_DIR = os.getenv('CLUSTER_SOCKET_DIR')  # Directory for worker sockets; a new temporary one by default
+CLUSTER_CONNECT_TIMEOUT = 30  # Seconds an update waits for its worker to (re)start before Telegram gets 503
+LEASE_NAME = 'background_jobs'
+LEASE_TTL = 15  # Seconds a lease stays valid without renewal
+LEASE_RENEW_INTERVAL = 5
+
+_HEADER = struct.Struct('>I')
+
+
+async def read_message(reader):
+    header = await reader.readexactly(_HEADER.size)
+    return json.loads(await reader.readexactly(_HEADER.unpack(header)[0]))
+
+
+def write_message(writer, message):
+    body = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+    writer.write(_HEADER.pack(len(body)) + body)
+
+
+def update_user_id(update):
+    """User an update belongs to; updates without a user fall back to the chat."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if user:
+                return user['id']
+            chat = value.get('chat')
+            if chat:
+                return chat['id']
+    return update.get('update_id', 0)
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_as_leader(jobs, name=LEASE_NAME):
+    """Run the job coroutine functions only while this process holds the lease.
+
+    The lease row in SQLite is renewed every LEASE_RENEW_INTERVAL seconds. Another process
+    takes it over LEASE_TTL seconds after the holder stops renewing, and a holder that
+    fails to renew cancels its jobs right away.
+    """
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    running = []
+    try:
+        while True:
+            try:
+                leader = await acquire_lease(name, holder, LEASE_TTL)
+            except Exception as e:
+                logging.error("Ошибка при продлении аренды %s: %s", name, e)
+                leader = False
+            if leader and not running:
+                logging.info("Процесс %s получил аренду %s, фоновые задачи запущены", holder, name)
+                running = [create_task(job(), f'job:{job.__name__}') for job in jobs]
+            elif not leader and running:
+                logging.warning("Процесс %s потерял аренду %s, фоновые задачи остановлены", holder, name)
+                await _cancel(running)
+                running = []
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+    finally:
+        if running:
+            await _cancel(running)
+            try:
+                await release_lease(name, holder)
+            except Exception as e:
+                logging.error("Ошибка при освобождении аренды %s: %s", name, e)
+
+
+class OrderedUpdateProcessor:
+    """Feeds raw updates to the dispatcher one at a time per user.
+
+    Different users are processed concurrently, at most max_in_flight updates in total
+    including queued ones; submit() waits for a free slot, which stops reading from the
+    socket and in turn slows the ingress down.
+    """
+
+    def __init__(self, dispatcher, bot, max_in_flight=TELEGRAM_MAX_IN_FLIGHT):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._capacity = asyncio.Semaphore(max_in_flight)
+        self._queues = {}  # user_id -> deque of updates waiting behind the one being processed
+        self._tasks = set()
+
+    async def submit(self, update):
+        await self._capacity.acquire()
+        user_id = update_user_id(update)
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._queues[user_id] = deque([update])
+        task = asyncio.create_task(self._drain(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, user_id):
+        queue = self._queues[user_id]
+        try:
+            while queue:
+                update = queue.popleft()
+                try:
+                    await self._process(update)
+                finally:
+                    self._capacity.release()
+        finally:
+            del self._queues[user_id]
+
+    async def _process(self, update):
+        try:
+            result = await self.dispatcher.feed_raw_update(self.bot, update)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, result)
+        except Exception:
+            logging.exception("Ошибка при обработке обновления %s", update.get('update_id'))
+
+    async def drain(self, timeout):
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        if pending:
+            logging.warning("Прервана обработка обновлений при остановке: %s", len(pending))
+            await _cancel(pending)
+
+
+class WorkerLink:
+    """Ingress side of one worker: starts the process, restarts it when it exits and talks to it."""
+
+    def __init__(self, index, socket_dir, env):
+        self.index = index
+        self.socket_path = os.path.join(socket_dir, f'worker-{index}.sock')
+        self.env = env
+        self.process = None
+        self.connected = asyncio.Event()
+        self._writer = None
+        self._stopping = False
+        self._supervisor = None
+
+    def start(self):
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        while not self._stopping:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), '--worker', str(self.index),
+                '--socket', self.socket_path, env=self.env)
+            try:
+                reader = await self._connect()
+                logging.info("Воркер %s запущен, pid %s", self.index, self.process.pid)
+                await self._read_events(reader)
+            except Exception as e:
+                if not self._stopping:
+                    logging.error("Ошибка связи с воркером %s: %s", self.index, e)
+            finally:
+                self.connected.clear()
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            if self.process.returncode is None and not self._stopping:
+                self.process.kill()
+            await self.process.wait()
+            if not self._stopping:
+                logging.error("Воркер %s завершился с кодом %s, перезапуск", self.index, self.process.returncode)
+                await asyncio.sleep(1)
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CLUSTER_CONNECT_TIMEOUT
+        while True:
+            if self.process.returncode is not None:
+                raise RuntimeError(f"worker exited with code {self.process.returncode} during startup")
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+                continue
+            self.connected.set()
+            return reader
+
+    async def _read_events(self, reader):
+        while True:
+            try:
+                message = await read_message(reader)
+            except asyncio.IncompleteReadError:
+                return
+            if 'subscription' in message:
+                # Планировщик истечения подписок работает только в процессе-лидере
+                notify_subscription_changed(*message['subscription'])
+            elif 'refill' in message:
+                # Воркер выдал ключ из пула, пополняет его тоже только лидер
+                request_refill()
+
+    async def send(self, message):
+        await asyncio.wait_for(self.connected.wait(), timeout=CLUSTER_CONNECT_TIMEOUT)
+        write_message(self._writer, message)
+        await self._writer.drain()
+
+    def post(self, message):
+        """Send without waiting; dropped while the worker restarts, which starts with empty caches anyway."""
+        if self.connected.is_set():
+            write_message(self._writer, message)
+
+    async def stop(self):
+        self._stopping = True
+        # Closing the connection makes the worker finish its updates and exit
+        if self._writer is not None:
+            self._writer.close()
+        if self.process is not None and self.process.returncode is None:
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=TELEGRAM_SHUTDOWN_TIMEOUT + 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        if self._supervisor is not None:
+            await _cancel([self._supervisor])
+
+
+class ClusterIngress:
+    """Receives the Telegram webhook and partitions updates between worker processes by user."""
+
+    def __init__(self, workers, socket_dir=CLUSTER_SOCKET_DIR):
+        self.socket_dir = socket_dir or tempfile.mkdtemp(prefix='hrvpn-cluster-')
+        os.makedirs(self.socket_dir, exist_ok=True)
+        # Telegram's limit applies to the whole bot, so each process sends its share
+        self.outbound_rate = OUTBOUND_GLOBAL_RATE / (workers + 1)
+        env = {**os.environ, 'OUTBOUND_GLOBAL_RATE': str(self.outbound_rate)}
+        self.links = [WorkerLink(index, self.socket_dir, env) for index in range(workers)]
+
+    def link_for(self, user_id):
+        return self.links[user_id % len(self.links)]
+
+    def setup(self, app):
+        app.router.add_post(TELEGRAM_WEBHOOK_PATH, self.handle_update)
+
+    async def start(self):
+        outbound_dispatcher.set_global_rate(self.outbound_rate)
+        add_invalidation_listener(self._forward_invalidation)
+        for link in self.links:
+            link.start()
+
+    async def stop(self):
+        await asyncio.gather(*(link.stop() for link in self.links))
+
+    def _forward_invalidation(self, user_ids):
+        # Подписки пользователя кэширует только его воркер
+        by_link = {}
+        for user_id in user_ids:
+            by_link.setdefault(self.link_for(user_id), []).append(user_id)
+        for link, ids in by_link.items():
+            link.post({'invalidate': ids})
+
+    async def handle_update(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+        # Сравниваем байты: compare_digest не принимает строки с не-ASCII символами
+        if token is None or not secrets.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+            return web.Response(text='Unauthorized', status=401)
+        update = await request.json()
+        try:
+            await self.link_for(update_user_id(update)).send({'update': update})
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            # Telegram повторит доставку обновления позже
+            logging.error("Обновление %s не передано воркеру: %s", update.get('update_id'), e)
+            raise web.HTTPServiceUnavailable()
+        return web.json_response({})
+
+
+async def run_worker(index, socket_path):
+    from telegram_bot import get_bot, get_dispatcher
+    from vpn_manager import close_manager
+
+    bot = get_bot()
+    dp = get_dispatcher()
+
+    if LOOP_MONITOR:
+        loop_monitor.start()
+    await init_db()
+    outbound_dispatcher.start(bot)
+    processor = OrderedUpdateProcessor(dp, bot)
+    stop = asyncio.Event()
+    connected = False
+
+    async def handle_connection(reader, writer):
+        nonlocal connected
+        if connected:
+            writer.close()
+            return
+        connected = True
+
+        def forward_subscription(sub_id, expires_at_ts):
+            if not writer.is_closing():
+                write_message(writer, {'subscription': [sub_id, expires_at_ts]})
+
+        def forward_refill():
+            if not writer.is_closing():
+                write_message(writer, {'refill': True})
+
+        add_subscription_listener(forward_subscription)
+        add_refill_listener(forward_refill)
+        try:
+            while True:
+                message = await read_message(reader)
+                if 'update' in message:
+                    await processor.submit(message['update'])
+                elif 'invalidate' in message:
+                    forget_subscriptions(*message['invalidate'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            remove_subscription_listener(forward_subscription)
+            remove_refill_listener(forward_refill)
+            # Входной процесс закрыл соединение или завершился
+            stop.set()
+
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await processor.drain(TELEGRAM_SHUTDOWN_TIMEOUT)
+        await outbound_dispatcher.stop()
+        await close_manager()
+        await close_db()
+        await loop_monitor.stop()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        logging.info("Воркер %s остановлен", index)
+
+
+if __name__ == '__main__':
+    from log_setup import setup_logging
+
+    parser = argparse.ArgumentParser(description="Telegram update worker started by the ingress")
+    parser.add_argument('--worker', type=int, required=True)
+    parser.add_argument('--socket', required=True)
+    args = parser.parse_args()
+    setup_logging()
+    asyncio.run(run_worker(args.worker, args.socket))
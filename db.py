@@ -1,181 +1,1166 @@
 # db.py
 import aiosqlite
+import asyncio
+import json
 import logging
+import os
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 
+from cache import TTLCache
+from metrics import Gauge, Histogram, add_collector
+
 DB_FILE = 'subscriptions.db'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))  # Number of reader connections
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', '256'))  # Prepared statements kept per connection
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))  # Cached per-user entries
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))  # Seconds a cached entry is trusted
+USER_FLUSH_INTERVAL = 0.3  # Seconds new users wait to be inserted in one batch
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=134217728',
+)
+
+
+class TrialAlreadyUsed(Exception):
+    """The user has already had a trial; the transaction that would record another was rolled back."""
+
+
+class ConnectionPool:
+    """One writer connection and a few reader connections kept open for the process lifetime.
+
+    SQLite allows a single writer at a time, so writes are serialized on one connection
+    behind a lock and always run inside an explicit transaction. Readers run concurrently
+    thanks to WAL mode.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = max(1, size)
+        self.loop = asyncio.get_running_loop()
+        self._writer = None
+        self._readers = []
+        self._opening_readers = 0
+        self._idle_readers = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._wait_stats = {
+            'reader': {'count': 0, 'total': 0.0, 'max': 0.0},
+            'writer': {'count': 0, 'total': 0.0, 'max': 0.0},
+        }
+
+    async def _connect(self, readonly):
+        conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=DB_STATEMENT_CACHE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute('PRAGMA query_only=1')
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # The writer goes first so that WAL mode is in place before readers attach.
+            # Readers are opened on demand, up to the pool size.
+            self._writer = await self._connect(readonly=False)
+            logging.info("Opened SQLite pool for %s (up to %s readers)", self.path, self.size)
+
+    async def close(self):
+        async with self._open_lock:
+            for conn in self._readers:
+                await conn.close()
+            if self._writer is not None:
+                await self._writer.close()
+            self._readers = []
+            self._idle_readers = asyncio.Queue()
+            self._writer = None
+
+    def _record_wait(self, kind, waited):
+        stats = self._wait_stats[kind]
+        stats['count'] += 1
+        stats['total'] += waited
+        stats['max'] = max(stats['max'], waited)
+
+    @asynccontextmanager
+    async def reader(self):
+        if self._writer is None:
+            await self.open()
+        started = time.perf_counter()
+        if self._idle_readers.empty() and self._opening_readers + len(self._readers) < self.size:
+            self._opening_readers += 1
+            try:
+                conn = await self._connect(readonly=True)
+            finally:
+                self._opening_readers -= 1
+            self._readers.append(conn)
+        else:
+            conn = await self._idle_readers.get()
+        self._record_wait('reader', time.perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        if self._writer is None:
+            await self.open()
+        started = time.perf_counter()
+        async with self._write_lock:
+            self._record_wait('writer', time.perf_counter() - started)
+            await self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+    def stats(self):
+        result = {
+            'readers_total': len(self._readers),
+            'readers_idle': self._idle_readers.qsize(),
+            'writer_locked': self._write_lock.locked(),
+        }
+        for kind, stats in self._wait_stats.items():
+            count = stats['count']
+            result[f'{kind}_acquires'] = count
+            result[f'{kind}_wait_avg_ms'] = round(stats['total'] / count * 1000, 3) if count else 0.0
+            result[f'{kind}_wait_max_ms'] = round(stats['max'] * 1000, 3)
+        return result
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.loop is not loop:
+        _pool = ConnectionPool(DB_FILE, DB_POOL_SIZE)
+    return _pool
+
+
+db_query_seconds = Histogram('hrvpn_db_query_seconds',
+                             "Time a db.py function holds a connection, including the wait for it",
+                             ('function', 'mode'))
+
+
+@asynccontextmanager
+async def _timed(connection, function, mode):
+    started = time.perf_counter()
+    try:
+        async with connection as db:
+            yield db
+    finally:
+        db_query_seconds.observe(time.perf_counter() - started, function, mode)
+
+
+def reader(operation):
+    """Borrow a read-only connection from the pool; operation labels the query timing."""
+    return _timed(get_pool().reader(), operation, 'read')
+
+
+def writer(operation):
+    """Run a block inside a write transaction on the shared writer connection; operation labels the timing."""
+    return _timed(get_pool().writer(), operation, 'write')
+
+
+async def close_db():
+    global _pool
+    if _user_flush_task is not None and not _user_flush_task.done():
+        _user_flush_task.cancel()
+        await asyncio.gather(_user_flush_task, return_exceptions=True)
+    if _pending_users and _pool is not None:
+        await flush_users()
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def pool_stats():
+    return _pool.stats() if _pool is not None else {}
+
+
+# Per-user state read on every /start and "my keys" tap: ('known' | 'used_test' | 'subscriptions', user_id).
+# The write paths below invalidate it after their transaction commits.
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_pending_users = set()
+_user_flush_task = None
+
+
+_invalidation_listeners = []
+
+
+def add_invalidation_listener(callback):
+    """Register callback(user_ids) called after a write in this process changed their subscriptions."""
+    _invalidation_listeners.append(callback)
+
+
+def forget_subscriptions(*user_ids):
+    """Drop cached subscriptions of users whose rows another process has changed."""
+    _user_cache.invalidate(*(('subscriptions', user_id) for user_id in user_ids))
+
+
+def _invalidate_subscriptions(*user_ids):
+    forget_subscriptions(*user_ids)
+    for callback in _invalidation_listeners:
+        try:
+            callback(user_ids)
+        except Exception as e:
+            logging.error("Invalidation listener failed for %s: %s", user_ids, e)
+
+
+def cache_stats():
+    return {**_user_cache.stats(), 'pending_users': len(_pending_users)}
+
+
+db_pool_gauge = Gauge('hrvpn_db_pool', "SQLite connection pool state", ('stat',))
+user_cache_gauge = Gauge('hrvpn_user_cache', "Per-user cache counters", ('stat',))
+subscriptions_gauge = Gauge('hrvpn_subscriptions', "Subscriptions by server and state", ('server', 'state'))
+pooled_keys_gauge = Gauge('hrvpn_pooled_keys', "Unassigned keys in the key pool", ('server',))
+
+
+async def _collect_metrics():
+    for stat, value in pool_stats().items():
+        db_pool_gauge.set(float(value), stat)
+    for stat, value in cache_stats().items():
+        user_cache_gauge.set(value, stat)
+    if _pool is None:
+        return
+    now_ts = int(time.time())
+    async with reader('_collect_metrics') as db:
+        subscriptions = await db.execute_fetchall(
+            'SELECT server, SUM(expires_at_ts > ?1), SUM(expires_at_ts <= ?1) FROM subscriptions GROUP BY server',
+            (now_ts,))
+        pooled = await db.execute_fetchall('SELECT server, COUNT(*) FROM key_pool GROUP BY server')
+    subscriptions_gauge.clear()
+    for server, active, expired in subscriptions:
+        subscriptions_gauge.set(active, server, 'active')
+        subscriptions_gauge.set(expired, server, 'expired')
+    pooled_keys_gauge.clear()
+    for server, count in pooled:
+        pooled_keys_gauge.set(count, server)
+
+
+add_collector(_collect_metrics)
+
+
+_subscription_listeners = []
+
+
+def add_subscription_listener(callback):
+    """Register callback(sub_id, expires_at_ts) called after a subscription expiry changes.
+
+    expires_at_ts is None when the subscription was deleted.
+    """
+    _subscription_listeners.append(callback)
+
+
+def remove_subscription_listener(callback):
+    _subscription_listeners.remove(callback)
+
+
+def notify_subscription_changed(sub_id, expires_at_ts):
+    """Run the subscription listeners; called after local writes and for changes relayed from other processes."""
+    for callback in _subscription_listeners:
+        try:
+            callback(sub_id, expires_at_ts)
+        except Exception as e:
+            logging.error("Subscription listener failed for %s: %s", sub_id, e)
+
+
+def parse_expires_at(value):
+    # Expiry timestamps are stored as naive UTC ISO strings
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def expires_at_from_ts(expires_at_ts):
+    return datetime.fromtimestamp(expires_at_ts, timezone.utc)
+
+
+async def _migrate_base_schema(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            key_id TEXT,
+            access_url TEXT,
+            expires_at TEXT,
+            notified_5_days BOOLEAN DEFAULT 0,
+            notified_1_day BOOLEAN DEFAULT 0,
+            notified_expired BOOLEAN DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS test_usage (
+            user_id INTEGER PRIMARY KEY,
+            used_at TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_interaction TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            period INTEGER,
+            action TEXT,
+            purchase_date TEXT,
+            label TEXT,
+            operation_id TEXT
+        )
+    ''')
+    # Add columns if they don't exist
+    columns = await db.execute_fetchall("PRAGMA table_info('subscriptions')")
+    column_names = [column[1] for column in columns]
+
+    if 'notified_5_days' not in column_names:
+        await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_5_days BOOLEAN DEFAULT 0')
+        logging.info("Added 'notified_5_days' column to 'subscriptions' table")
+
+    if 'notified_1_day' not in column_names:
+        await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_1_day BOOLEAN DEFAULT 0')
+        logging.info("Added 'notified_1_day' column to 'subscriptions' table")
+
+    if 'notified_expired' not in column_names:
+        await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_expired BOOLEAN DEFAULT 0')
+        logging.info("Added 'notified_expired' column to 'subscriptions' table")
+
+
+async def _migrate_indexes(db):
+    # Duplicate notifications used to slip past the COUNT check, keep the first record only
+    cursor = await db.execute('''
+        DELETE FROM purchase_history
+        WHERE operation_id IS NOT NULL
+          AND id NOT IN (SELECT MIN(id) FROM purchase_history GROUP BY operation_id)
+    ''')
+    if cursor.rowcount:
+        logging.warning("Deleted %s duplicate purchase_history rows before adding the unique operation_id index",
+                        cursor.rowcount)
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_key_id ON subscriptions(key_id)')
+    await db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_purchase_history_operation_id '
+                     'ON purchase_history(operation_id)')
 
-async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                key_id TEXT,
-                access_url TEXT,
-                expires_at TEXT,
-                notified_5_days BOOLEAN DEFAULT 0,
-                notified_1_day BOOLEAN DEFAULT 0,
-                notified_expired BOOLEAN DEFAULT 0
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS test_usage (
-                user_id INTEGER PRIMARY KEY,
-                used_at TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                first_interaction TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS purchase_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                period INTEGER,
-                action TEXT,
-                purchase_date TEXT,
-                label TEXT,
-                operation_id TEXT
-            )
-        ''')
-        # Add columns if they don't exist
-        cursor = await db.execute("PRAGMA table_info('subscriptions')")
-        columns = await cursor.fetchall()
-        column_names = [column[1] for column in columns]
 
-        if 'notified_5_days' not in column_names:
-            await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_5_days BOOLEAN DEFAULT 0')
-            logging.info("Added 'notified_5_days' column to 'subscriptions' table")
+async def _migrate_expiry_epoch(db):
+    columns = await db.execute_fetchall("PRAGMA table_info('subscriptions')")
+    if 'expires_at_ts' not in [column[1] for column in columns]:
+        await db.execute('ALTER TABLE subscriptions ADD COLUMN expires_at_ts INTEGER')
+    rows = await db.execute_fetchall('SELECT id, expires_at FROM subscriptions WHERE expires_at_ts IS NULL')
+    backfill = []
+    for sub_id, expires_at_str in rows:
+        try:
+            expires_at = parse_expires_at(expires_at_str)
+        except (TypeError, ValueError):
+            # Unparseable values used to be treated as "expires now"
+            expires_at = datetime.now(timezone.utc)
+        backfill.append((int(expires_at.timestamp()), sub_id))
+    await db.executemany('UPDATE subscriptions SET expires_at_ts = ? WHERE id = ?', backfill)
+    # Databases migrated by earlier versions of migration 2 have an index on the text column
+    await db.execute('DROP INDEX IF EXISTS idx_subscriptions_expires_at')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at_ts ON subscriptions(expires_at_ts)')
+    logging.info("Backfilled expires_at_ts for %s subscriptions", len(backfill))
 
-        if 'notified_1_day' not in column_names:
-            await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_1_day BOOLEAN DEFAULT 0')
-            logging.info("Added 'notified_1_day' column to 'subscriptions' table")
 
-        if 'notified_expired' not in column_names:
-            await db.execute('ALTER TABLE subscriptions ADD COLUMN notified_expired BOOLEAN DEFAULT 0')
-            logging.info("Added 'notified_expired' column to 'subscriptions' table")
+# Numbered schema migrations. Each entry is either a coroutine taking the writer
+# connection or a tuple of SQL statements; the applied version is kept in PRAGMA user_version.
+MIGRATIONS = [
+    (1, _migrate_base_schema),
+    (2, _migrate_indexes),
+    (3, _migrate_expiry_epoch),
+    (4, (
+        # Pre-created Outline keys waiting to be handed out
+        '''
+        CREATE TABLE IF NOT EXISTS key_pool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_id TEXT NOT NULL,
+            access_url TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        ''',
+    )),
+    (5, (
+        # Broadcast jobs with a keyset cursor over user_id and per-recipient delivery state
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            segment_days INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',
+            cursor_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_expiry ON subscriptions(user_id, expires_at_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_purchase_history_user_id ON purchase_history(user_id)',
+    )),
+    (6, (
+        # Name of the Outline server holding the key; existing keys live on the original server
+        "ALTER TABLE subscriptions ADD COLUMN server TEXT NOT NULL DEFAULT 'default'",
+        "ALTER TABLE key_pool ADD COLUMN server TEXT NOT NULL DEFAULT 'default'",
+    )),
+    (7, (
+        # Per-subscription traffic: last seen Outline counter, raw deltas and hourly/daily rollups.
+        # Integer-only WITHOUT ROWID tables keep every row a few bytes in the primary key b-tree.
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_counters (
+            sub_id INTEGER PRIMARY KEY,
+            bytes INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_samples (
+            sub_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (sub_id, ts)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_hourly (
+            sub_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (sub_id, hour)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS traffic_daily (
+            sub_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (sub_id, day)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_traffic_samples_ts ON traffic_samples(ts)',
+        'CREATE INDEX IF NOT EXISTS idx_traffic_hourly_hour ON traffic_hourly(hour)',
+    )),
+    (8, (
+        # YooMoney notifications accepted by the webhook and processed by payments.run_payment_worker
+        '''
+        CREATE TABLE IF NOT EXISTS payment_inbox (
+            operation_id TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            last_error TEXT,
+            received_at INTEGER NOT NULL,
+            processed_at INTEGER
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_payment_inbox_pending ON payment_inbox(status, next_attempt_at)',
+    )),
+    (9, (
+        # aiogram FSM state shared by all worker processes (fsm_storage.SQLiteStorage)
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        ) WITHOUT ROWID
+        ''',
+        # Leases of singleton jobs; the holder renews its row before expires_at passes
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    )),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-        await db.commit()
+
+async def get_schema_version(db):
+    rows = await db.execute_fetchall('PRAGMA user_version')
+    return rows[0][0]
+
+
+async def init_db():
+    # Fast path: an up-to-date database only costs one pragma read
+    async with reader('init_db') as db:
+        if await get_schema_version(db) >= SCHEMA_VERSION:
+            return
+
+    async with writer('init_db') as db:
+        current_version = await get_schema_version(db)
+        for version, migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            if callable(migration):
+                await migration(db)
+            else:
+                for statement in migration:
+                    await db.execute(statement)
+            await db.execute(f'PRAGMA user_version = {version}')
+            logging.info("Applied database migration %s", version)
+
+async def _insert_purchase_history(db, user_id, amount, period, action, label, operation_id):
+    await db.execute('''
+        INSERT INTO purchase_history (user_id, amount, period, action, label, purchase_date, operation_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, amount, period, action, label, datetime.now(timezone.utc).isoformat(), operation_id))
+
+async def _record_payment(db, user_id, payment):
+    # Purchase history and the inbox entry change together with the subscription they paid for;
+    # the unique operation_id makes a second attempt roll the whole transaction back
+    await _insert_purchase_history(db, user_id, payment['amount'], payment['period'], payment['action'],
+                                   payment['label'], payment['operation_id'])
+    await db.execute('''
+        UPDATE payment_inbox SET status = 'done', processed_at = ?, last_error = NULL WHERE operation_id = ?
+    ''', (int(time.time()), payment['operation_id']))
 
 async def save_purchase_history(user_id, amount, period, action, label, operation_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT INTO purchase_history (user_id, amount, period, action, label, purchase_date, operation_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, amount, period, action, label, datetime.now(timezone.utc).isoformat(), operation_id))
-        await db.commit()
-    logging.info(f"Purchase history for user {user_id} saved.")
+    async with writer('save_purchase_history') as db:
+        await _insert_purchase_history(db, user_id, amount, period, action, label, operation_id)
+    logging.info("Purchase history for user %s saved.", user_id)
+
+async def is_operation_processed(operation_id):
+    async with reader('is_operation_processed') as db:
+        rows = await db.execute_fetchall('''
+            SELECT 1 FROM purchase_history WHERE operation_id = ? LIMIT 1
+        ''', (operation_id,))
+        return bool(rows)
+
+async def _record_trial(db, user_id):
+    # test_usage.user_id is the primary key: a second trial rolls the whole transaction back
+    cursor = await db.execute('INSERT OR IGNORE INTO test_usage (user_id, used_at) VALUES (?, ?)',
+                              (user_id, datetime.now(timezone.utc).isoformat()))
+    if cursor.rowcount == 0:
+        _remember_trial(user_id)
+        raise TrialAlreadyUsed(user_id)
 
-async def save_subscription(user_id, key_data, duration_days):
+def _remember_trial(user_id):
+    _user_cache.invalidate(('used_test', user_id))
+    _user_cache.set(('used_test', user_id), True)
+
+async def _insert_subscription(db, user_id, server, key_id, access_url, duration_days):
     expires_at = datetime.now(timezone.utc) + timedelta(days=duration_days)
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT INTO subscriptions (user_id, key_id, access_url, expires_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, key_data['id'], key_data['accessUrl'], expires_at.isoformat()))
-        await db.commit()
-    logging.info(f"Subscription for user {user_id} saved until {expires_at}")
+    expires_at_ts = int(expires_at.timestamp())
+    cursor = await db.execute('''
+        INSERT INTO subscriptions (user_id, server, key_id, access_url, expires_at, expires_at_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, server, key_id, access_url, expires_at.isoformat(), expires_at_ts))
+    return cursor.lastrowid, expires_at
+
+async def save_subscription(user_id, key_data, duration_days, payment=None, trial=False):
+    """Raises TrialAlreadyUsed, saving nothing, if trial is set and the user has had one."""
+    async with writer('save_subscription') as db:
+        if trial:
+            await _record_trial(db, user_id)
+        sub_id, expires_at = await _insert_subscription(
+            db, user_id, key_data['server'], key_data['id'], key_data['accessUrl'], duration_days)
+        if payment is not None:
+            await _record_payment(db, user_id, payment)
+    if trial:
+        _remember_trial(user_id)
+    _invalidate_subscriptions(user_id)
+    notify_subscription_changed(sub_id, int(expires_at.timestamp()))
+    logging.info("Subscription for user %s saved until %s", user_id, expires_at,
+                 extra={'user_id': user_id, 'sub_id': sub_id})
+
+async def claim_pooled_key(user_id, duration_days, server=None, payment=None, trial=False):
+    """Move the oldest pooled key (on the given server, if any) into a new subscription in one transaction.
+
+    Returns (sub_id, key_data), or None when the pool is empty. Raises TrialAlreadyUsed, leaving
+    the key in the pool, if trial is set and the user has had one.
+    """
+    async with writer('claim_pooled_key') as db:
+        if server is None:
+            rows = await db.execute_fetchall(
+                'SELECT id, server, key_id, access_url FROM key_pool ORDER BY id LIMIT 1')
+        else:
+            rows = await db.execute_fetchall(
+                'SELECT id, server, key_id, access_url FROM key_pool WHERE server = ? ORDER BY id LIMIT 1',
+                (server,))
+        if not rows:
+            return None
+        pool_id, server, key_id, access_url = rows[0]
+        if trial:
+            await _record_trial(db, user_id)
+        await db.execute('DELETE FROM key_pool WHERE id = ?', (pool_id,))
+        sub_id, expires_at = await _insert_subscription(db, user_id, server, key_id, access_url, duration_days)
+        if payment is not None:
+            await _record_payment(db, user_id, payment)
+    if trial:
+        _remember_trial(user_id)
+    _invalidate_subscriptions(user_id)
+    notify_subscription_changed(sub_id, int(expires_at.timestamp()))
+    logging.info("Pooled key %s on %s assigned to user %s until %s", key_id, server, user_id, expires_at,
+                 extra={'user_id': user_id, 'sub_id': sub_id, 'key_id': key_id, 'server': server})
+    return sub_id, {'id': key_id, 'accessUrl': access_url, 'server': server}
+
+async def add_pooled_key(key_data):
+    async with writer('add_pooled_key') as db:
+        await db.execute('INSERT INTO key_pool (server, key_id, access_url, created_at) VALUES (?, ?, ?, ?)',
+                         (key_data['server'], key_data['id'], key_data['accessUrl'], int(time.time())))
+
+async def count_pooled_keys():
+    async with reader('count_pooled_keys') as db:
+        rows = await db.execute_fetchall('SELECT COUNT(*) FROM key_pool')
+        return rows[0][0]
 
 async def get_subscriptions(user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT id, key_id, access_url, expires_at FROM subscriptions WHERE user_id = ?
-        ''', (user_id,))
-        rows = await cursor.fetchall()
-        subscriptions = []
-        for row in rows:
-            sub_id, key_id, access_url, expires_at_str = row
-            try:
-                expires_at = datetime.fromisoformat(expires_at_str).replace(tzinfo=timezone.utc)
-            except ValueError:
-                expires_at = datetime.now(timezone.utc)
-            subscriptions.append({
-                'id': sub_id,
-                'key_id': key_id,
-                'access_url': access_url,
-                'expires_at': expires_at
-            })
+    subscriptions = _user_cache.get(('subscriptions', user_id))
+    if subscriptions is not None:
         return subscriptions
+    generation = _user_cache.generation
+    async with reader('get_subscriptions') as db:
+        rows = await db.execute_fetchall('''
+            SELECT id, key_id, access_url, expires_at_ts FROM subscriptions WHERE user_id = ?
+        ''', (user_id,))
+    subscriptions = []
+    for row in rows:
+        sub_id, key_id, access_url, expires_at_ts = row
+        subscriptions.append({
+            'id': sub_id,
+            'key_id': key_id,
+            'access_url': access_url,
+            'expires_at': expires_at_from_ts(expires_at_ts)
+        })
+    _user_cache.set(('subscriptions', user_id), subscriptions, generation)
+    return subscriptions
 
 async def delete_subscription(sub_id, user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with writer('delete_subscription') as db:
         await db.execute('''
             DELETE FROM subscriptions WHERE id = ?
         ''', (sub_id,))
-        await db.commit()
-    logging.info(f"Subscription {sub_id} for user {user_id} deleted")
+    _invalidate_subscriptions(user_id)
+    notify_subscription_changed(sub_id, None)
+    logging.info("Subscription %s for user %s deleted", sub_id, user_id, extra={'user_id': user_id, 'sub_id': sub_id})
 
-async def extend_subscription(user_id, sub_id, additional_days):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT expires_at FROM subscriptions
+async def delete_subscriptions(sub_ids):
+    """Delete many subscriptions in one transaction; returns (id, user_id) of the deleted rows."""
+    async with writer('delete_subscriptions') as db:
+        rows = await db.execute_fetchall('''
+            DELETE FROM subscriptions WHERE id IN (SELECT value FROM json_each(?)) RETURNING id, user_id
+        ''', (json.dumps(list(sub_ids)),))
+    _invalidate_subscriptions(*set(row[1] for row in rows))
+    for row in rows:
+        notify_subscription_changed(row[0], None)
+    logging.info("Deleted %s expired subscriptions", len(rows))
+    return rows
+
+async def extend_subscription(user_id, sub_id, additional_days, payment=None):
+    async with writer('extend_subscription') as db:
+        if payment is not None:
+            await _record_payment(db, user_id, payment)
+        rows = await db.execute_fetchall('''
+            SELECT expires_at_ts FROM subscriptions
             WHERE id = ? AND user_id = ? LIMIT 1
         ''', (sub_id, user_id))
-        row = await cursor.fetchone()
-        if row:
-            current_expires_at_str = row[0]
-            current_expires_at = datetime.fromisoformat(current_expires_at_str).replace(tzinfo=timezone.utc)
+        if rows:
+            current_expires_at = expires_at_from_ts(rows[0][0])
             if current_expires_at > datetime.now(timezone.utc):
                 new_expires_at = current_expires_at + timedelta(days=additional_days)
             else:
                 new_expires_at = datetime.now(timezone.utc) + timedelta(days=additional_days)
             await db.execute('''
-                UPDATE subscriptions SET expires_at = ?
+                UPDATE subscriptions SET expires_at = ?, expires_at_ts = ?
                 WHERE id = ? AND user_id = ?
-            ''', (new_expires_at.isoformat(), sub_id, user_id))
-            await db.commit()
-            logging.info(f"Subscription {sub_id} for user {user_id} extended until {new_expires_at}")
+            ''', (new_expires_at.isoformat(), int(new_expires_at.timestamp()), sub_id, user_id))
+            logging.info("Subscription %s for user %s extended until %s", sub_id, user_id, new_expires_at,
+                         extra={'user_id': user_id, 'sub_id': sub_id})
         else:
-            logging.error(f"Subscription {sub_id} for user {user_id} not found")
+            logging.error("Subscription %s for user %s not found", sub_id, user_id)
+            return False
+    _invalidate_subscriptions(user_id)
+    notify_subscription_changed(sub_id, int(new_expires_at.timestamp()))
+    return True
 
 async def add_user(user_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('''
-            INSERT OR IGNORE INTO users (user_id, first_interaction)
-            VALUES (?, ?)
-        ''', (user_id, datetime.now(timezone.utc).isoformat()))
-        await db.commit()
-
-async def get_all_subscriptions():
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT id, user_id, key_id, access_url, expires_at FROM subscriptions')
-        rows = await cursor.fetchall()
-        subscriptions = []
-        for row in rows:
-            sub_id, user_id, key_id, access_url, expires_at_str = row
-            expires_at = datetime.fromisoformat(expires_at_str).replace(tzinfo=timezone.utc)
-            subscriptions.append({
-                'id': sub_id,
-                'user_id': user_id,
-                'key_id': key_id,
-                'access_url': access_url,
-                'expires_at': expires_at
-            })
-        return subscriptions
+    # Write-behind: users seen recently are skipped, new ones are inserted in batches by flush_users
+    global _user_flush_task
+    if _user_cache.get(('known', user_id)):
+        return
+    _user_cache.set(('known', user_id), True)
+    _pending_users.add(user_id)
+    if _user_flush_task is None or _user_flush_task.done():
+        _user_flush_task = asyncio.create_task(_flush_users_later())
+
+async def _flush_users_later():
+    # add_user does not start another task while this one waits for the writer,
+    # so users it queued meanwhile are written in the next round
+    while _pending_users:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await flush_users()
+
+async def flush_users():
+    batch = list(_pending_users)
+    _pending_users.clear()
+    if not batch:
+        return
+    first_interaction = datetime.now(timezone.utc).isoformat()
+    try:
+        async with writer('flush_users') as db:
+            await db.executemany('''
+                INSERT OR IGNORE INTO users (user_id, first_interaction)
+                VALUES (?, ?)
+            ''', [(user_id, first_interaction) for user_id in batch])
+    except asyncio.CancelledError:
+        # Shutting down: close_db writes the batch once more
+        _pending_users.update(batch)
+        raise
+    except Exception as e:
+        logging.error("Error saving %s new users: %s", len(batch), e)
+        # Forget them so the next /start queues them again
+        _user_cache.invalidate(*(('known', user_id) for user_id in batch))
+
+async def has_used_test(user_id):
+    used_test = _user_cache.get(('used_test', user_id))
+    if used_test is not None:
+        return used_test
+    generation = _user_cache.generation
+    async with reader('has_used_test') as db:
+        rows = await db.execute_fetchall('SELECT 1 FROM test_usage WHERE user_id = ? LIMIT 1', (user_id,))
+    _user_cache.set(('used_test', user_id), bool(rows), generation)
+    return bool(rows)
+
+# Sort orders of the admin subscriptions page. Every index on subscriptions also holds the
+# rowid, so (column, id) keysets are served by idx_subscriptions_user_id, idx_subscriptions_expires_at_ts
+# or the primary key without a temporary sort.
+SUBSCRIPTION_SORTS = {
+    'id': 'id',
+    'user_id': 'user_id',
+    'expires_at': 'expires_at_ts',
+}
+
+async def get_subscriptions_page(sort='id', descending=False, after=None, before=None, user_id=None,
+                                 key_id=None, status=None, days=None, limit=50):
+    """Return one page of subscriptions and whether more rows follow in the direction of travel.
+
+    after/before are (sort value, id) cursors taken from the last/first row of the current page.
+    status is None, 'expiring' (expires within `days`) or 'expired'.
+    """
+    column = SUBSCRIPTION_SORTS[sort]
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if key_id:
+        conditions.append('key_id = ?')
+        params.append(key_id)
+    now = int(time.time())
+    if status == 'expiring':
+        conditions.append('expires_at_ts > ? AND expires_at_ts <= ?')
+        params.extend((now, now + (days or 0) * 86400))
+    elif status == 'expired':
+        conditions.append('expires_at_ts <= ?')
+        params.append(now)
+
+    # Walking backwards from `before` reverses the order, the rows are flipped back below
+    backwards = before is not None
+    ascending = descending == backwards
+    cursor = before if backwards else after
+    if cursor is not None:
+        operator = '>' if ascending else '<'
+        if column == 'id':
+            conditions.append(f'id {operator} ?')
+            params.append(cursor[1])
+        else:
+            conditions.append(f'({column}, id) {operator} (?, ?)')
+            params.extend(cursor)
+    direction = 'ASC' if ascending else 'DESC'
+    order = f'id {direction}' if column == 'id' else f'{column} {direction}, id {direction}'
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    async with reader('get_subscriptions_page') as db:
+        rows = await db.execute_fetchall(f'''
+            SELECT id, user_id, server, key_id, access_url, expires_at_ts FROM subscriptions
+            {where} ORDER BY {order} LIMIT ?
+        ''', (*params, limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    subscriptions = []
+    for row in rows:
+        sub_id, sub_user_id, server, sub_key_id, access_url, expires_at_ts = row
+        subscriptions.append({
+            'id': sub_id,
+            'user_id': sub_user_id,
+            'server': server,
+            'key_id': sub_key_id,
+            'access_url': access_url,
+            'expires_at_ts': expires_at_ts,
+            'expires_at': expires_at_from_ts(expires_at_ts)
+        })
+    return subscriptions, has_more
+
+# Expiry windows as (lower bound offset, upper bound offset, notification flag), in seconds from now.
+# A subscription is due when now + lower < expires_at_ts <= now + upper and the flag is not set yet.
+EXPIRY_WINDOWS = {
+    '5_days': (4 * 86400, 5 * 86400, 'notified_5_days'),
+    '1_day': (0, 86400, 'notified_1_day'),
+    'expired': (None, 0, 'notified_expired'),
+}
+
+
+async def get_subscriptions_due(window, now_ts):
+    """Return (id, user_id, key_id, server) of subscriptions inside an expiry window that were not handled yet."""
+    lower, upper, flag = EXPIRY_WINDOWS[window]
+    query = f'SELECT id, user_id, key_id, server FROM subscriptions WHERE expires_at_ts <= ? AND {flag} = 0'
+    params = [now_ts + upper]
+    if lower is not None:
+        query += ' AND expires_at_ts > ?'
+        params.append(now_ts + lower)
+    async with reader('get_subscriptions_due') as db:
+        return await db.execute_fetchall(query + ' ORDER BY expires_at_ts', params)
+
+async def get_upcoming_expiries(from_ts, until_ts):
+    """Return (id, expires_at_ts) of subscriptions expiring in (from_ts, until_ts]."""
+    async with reader('get_upcoming_expiries') as db:
+        return await db.execute_fetchall('''
+            SELECT id, expires_at_ts FROM subscriptions
+            WHERE expires_at_ts > ? AND expires_at_ts <= ?
+        ''', (from_ts, until_ts))
+
+async def mark_subscriptions_notified(sub_ids, column):
+    """Set a notification flag on many subscriptions in one transaction."""
+    if column not in ('notified_5_days', 'notified_1_day', 'notified_expired'):
+        raise ValueError(f"Unknown notification column: {column}")
+    async with writer('mark_subscriptions_notified') as db:
+        await db.execute(f'UPDATE subscriptions SET {column} = 1 WHERE id IN (SELECT value FROM json_each(?))',
+                         (json.dumps(list(sub_ids)),))
+
+async def get_all_key_ids(server):
+    async with reader('get_all_key_ids') as db:
+        # Pooled keys are not assigned yet but must survive the sync with the server
+        rows = await db.execute_fetchall('''
+            SELECT key_id FROM subscriptions WHERE server = ?
+            UNION SELECT key_id FROM key_pool WHERE server = ?
+        ''', (server, server))
+        return set(row[0] for row in rows)
+
+async def delete_subscriptions_by_key_ids(server, key_ids):
+    """Drop subscriptions and pooled keys whose keys are gone from the server in one transaction."""
+    key_ids_json = json.dumps(list(key_ids))
+    async with writer('delete_subscriptions_by_key_ids') as db:
+        rows = await db.execute_fetchall('''
+            DELETE FROM subscriptions
+            WHERE server = ? AND key_id IN (SELECT value FROM json_each(?)) RETURNING id, user_id
+        ''', (server, key_ids_json))
+        cursor = await db.execute(
+            'DELETE FROM key_pool WHERE server = ? AND key_id IN (SELECT value FROM json_each(?))',
+            (server, key_ids_json))
+        pooled_deleted = cursor.rowcount
+    _invalidate_subscriptions(*set(row[1] for row in rows))
+    for row in rows:
+        notify_subscription_changed(row[0], None)
+    logging.info("Deleted %s subscriptions and %s pooled keys missing on %s", len(rows), pooled_deleted, server)
+    return len(rows) + pooled_deleted
 
 async def get_all_users():
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT user_id FROM users')
-        users = await cursor.fetchall()
+    async with reader('get_all_users') as db:
+        users = await db.execute_fetchall('SELECT user_id FROM users')
         return [{'user_id': row[0]} for row in users]
 
+# Broadcast audiences as (table, condition on its rows). Pages and totals are both built from
+# them; pages walk user_id from a keyset cursor (user_id > :cursor), served by the primary key
+# of users or by idx_subscriptions_user_expiry.
+AUDIENCE_SEGMENTS = {
+    'all': ('users', '1'),
+    'active': ('subscriptions', 'expires_at_ts > :now'),
+    'expiring': ('subscriptions', 'expires_at_ts > :now AND expires_at_ts <= :now + :days * 86400'),
+    'never_paid': ('users', '''
+        NOT EXISTS (SELECT 1 FROM purchase_history WHERE purchase_history.user_id = users.user_id)
+    '''),
+}
+
+async def get_audience_batch(segment, cursor_user_id, limit, days=None):
+    table, condition = AUDIENCE_SEGMENTS[segment]
+    query = f'''
+        SELECT DISTINCT user_id FROM {table}
+        WHERE user_id > :cursor AND ({condition})
+        ORDER BY user_id LIMIT :limit
+    '''
+    params = {'cursor': cursor_user_id, 'limit': limit, 'now': int(time.time()), 'days': days or 0}
+    async with reader('get_audience_batch') as db:
+        rows = await db.execute_fetchall(query, params)
+        return [row[0] for row in rows]
+
+async def count_audience(segment, days=None):
+    table, condition = AUDIENCE_SEGMENTS[segment]
+    query = f'SELECT COUNT(DISTINCT user_id) FROM {table} WHERE {condition}'
+    params = {'now': int(time.time()), 'days': days or 0}
+    async with reader('count_audience') as db:
+        rows = await db.execute_fetchall(query, params)
+        return rows[0][0]
+
+async def create_broadcast_job(message, segment, segment_days=None):
+    if segment not in AUDIENCE_SEGMENTS:
+        raise ValueError(f"Unknown audience segment: {segment}")
+    async with writer('create_broadcast_job') as db:
+        cursor = await db.execute('''
+            INSERT INTO broadcast_jobs (message, segment, segment_days, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (message, segment, segment_days, int(time.time())))
+        job_id = cursor.lastrowid
+    logging.info("Broadcast job %s for segment '%s' queued", job_id, segment, extra={'job_id': job_id})
+    return job_id
+
+BROADCAST_JOB_COLUMNS = ('id', 'message', 'segment', 'segment_days', 'status', 'cursor_user_id',
+                         'total', 'sent', 'failed', 'created_at', 'started_at', 'finished_at')
+
+async def get_broadcast_job(job_id):
+    async with reader('get_broadcast_job') as db:
+        rows = await db.execute_fetchall(
+            f"SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs WHERE id = ?", (job_id,))
+    return dict(zip(BROADCAST_JOB_COLUMNS, rows[0])) if rows else None
+
+async def get_recent_broadcast_jobs(limit=20):
+    async with reader('get_recent_broadcast_jobs') as db:
+        rows = await db.execute_fetchall(
+            f"SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs ORDER BY id DESC LIMIT ?", (limit,))
+    return [dict(zip(BROADCAST_JOB_COLUMNS, row)) for row in rows]
+
+async def get_next_broadcast_job():
+    """Return the oldest unfinished job; a 'running' one is resumed after a restart."""
+    async with reader('get_next_broadcast_job') as db:
+        rows = await db.execute_fetchall(f'''
+            SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs
+            WHERE status IN ('queued', 'running') ORDER BY id LIMIT 1
+        ''')
+    return dict(zip(BROADCAST_JOB_COLUMNS, rows[0])) if rows else None
+
+async def start_broadcast_job(job_id, total):
+    async with writer('start_broadcast_job') as db:
+        await db.execute('''
+            UPDATE broadcast_jobs SET status = 'running', total = COALESCE(total, ?),
+                started_at = COALESCE(started_at, ?)
+            WHERE id = ?
+        ''', (total, int(time.time()), job_id))
+
+async def finish_broadcast_job(job_id, status='done'):
+    async with writer('finish_broadcast_job') as db:
+        await db.execute('UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?',
+                         (status, int(time.time()), job_id))
+
+async def get_pending_deliveries(job_id):
+    async with reader('get_pending_deliveries') as db:
+        rows = await db.execute_fetchall(
+            "SELECT user_id FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending'", (job_id,))
+        return [row[0] for row in rows]
+
+async def checkpoint_broadcast_batch(job_id, user_ids):
+    """Record a batch as pending and move the job cursor past it in one transaction."""
+    async with writer('checkpoint_broadcast_batch') as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, 'pending')",
+            [(job_id, user_id) for user_id in user_ids])
+        await db.execute('UPDATE broadcast_jobs SET cursor_user_id = ? WHERE id = ?', (max(user_ids), job_id))
+
+async def record_broadcast_results(job_id, results):
+    """Store delivery results given as (user_id, error or None) pairs."""
+    sent = sum(1 for _, error in results if error is None)
+    async with writer('record_broadcast_results') as db:
+        await db.executemany('''
+            UPDATE broadcast_deliveries SET status = ?, error = ?
+            WHERE job_id = ? AND user_id = ?
+        ''', [('sent' if error is None else 'failed', error, job_id, user_id) for user_id, error in results])
+        await db.execute('UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?',
+                         (sent, len(results) - sent, job_id))
+
 async def update_subscription_async(sub_id, new_expires_at):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('UPDATE subscriptions SET expires_at = ? WHERE id = ?', (new_expires_at, sub_id))
-        await db.commit()
+    # Raises ValueError for dates that are not in ISO format
+    expires_at_ts = int(parse_expires_at(new_expires_at).timestamp())
+    async with writer('update_subscription_async') as db:
+        rows = await db.execute_fetchall('''
+            UPDATE subscriptions SET expires_at = ?, expires_at_ts = ? WHERE id = ? RETURNING user_id
+        ''', (new_expires_at, expires_at_ts, sub_id))
+    _invalidate_subscriptions(*(row[0] for row in rows))
+    notify_subscription_changed(sub_id, expires_at_ts)
 
 async def get_subscription_expiry_async(sub_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT expires_at FROM subscriptions WHERE id = ?', (sub_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else None
+    async with reader('get_subscription_expiry_async') as db:
+        rows = await db.execute_fetchall('SELECT expires_at FROM subscriptions WHERE id = ?', (sub_id,))
+        return rows[0][0] if rows else None
 
 async def delete_subscription_async(sub_id):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute('DELETE FROM subscriptions WHERE id = ?', (sub_id,))
-        await db.commit()
+    """Delete a subscription and return (server, key_id) of its key, or None if it did not exist."""
+    async with writer('delete_subscription_async') as db:
+        rows = await db.execute_fetchall('DELETE FROM subscriptions WHERE id = ? RETURNING server, key_id, user_id',
+                                         (sub_id,))
+    _invalidate_subscriptions(*(row[2] for row in rows))
+    notify_subscription_changed(sub_id, None)
+    return (rows[0][0], rows[0][1]) if rows else None
+
+async def record_traffic(server, bytes_by_key_id, now_ts):
+    """Store transfer deltas since the previous collection for the keys of one server.
+
+    bytes_by_key_id are Outline's cumulative counters. Pooled keys without a subscription
+    are ignored. Returns (number of subscriptions with traffic, total delta in bytes).
+    """
+    async with writer('record_traffic') as db:
+        rows = await db.execute_fetchall('''
+            SELECT subscriptions.id, CAST(metrics.value AS INTEGER), traffic_counters.bytes
+            FROM json_each(?) AS metrics
+            JOIN subscriptions ON subscriptions.server = ? AND subscriptions.key_id = metrics.key
+            LEFT JOIN traffic_counters ON traffic_counters.sub_id = subscriptions.id
+        ''', (json.dumps(bytes_by_key_id), server))
+        deltas = []
+        for sub_id, counter, previous in rows:
+            if previous is None:
+                # First sample of the key: the counter only becomes the baseline, the traffic
+                # before it was transferred at an unknown time
+                continue
+            # Outline reports a sliding window, so a counter may go down; that is not new traffic
+            delta = counter - previous
+            if delta > 0:
+                deltas.append((sub_id, delta))
+        hour = now_ts // 3600
+        day = now_ts // 86400
+        await db.executemany('INSERT OR REPLACE INTO traffic_counters (sub_id, bytes) VALUES (?, ?)',
+                             [(sub_id, counter) for sub_id, counter, _ in rows])
+        await db.executemany('''
+            INSERT INTO traffic_samples (sub_id, ts, bytes) VALUES (?, ?, ?)
+            ON CONFLICT (sub_id, ts) DO UPDATE SET bytes = bytes + excluded.bytes
+        ''', [(sub_id, now_ts, delta) for sub_id, delta in deltas])
+        await db.executemany('''
+            INSERT INTO traffic_hourly (sub_id, hour, bytes) VALUES (?, ?, ?)
+            ON CONFLICT (sub_id, hour) DO UPDATE SET bytes = bytes + excluded.bytes
+        ''', [(sub_id, hour, delta) for sub_id, delta in deltas])
+        await db.executemany('''
+            INSERT INTO traffic_daily (sub_id, day, bytes) VALUES (?, ?, ?)
+            ON CONFLICT (sub_id, day) DO UPDATE SET bytes = bytes + excluded.bytes
+        ''', [(sub_id, day, delta) for sub_id, delta in deltas])
+    return len(deltas), sum(delta for _, delta in deltas)
+
+async def compact_traffic(samples_before_ts, hourly_before_ts):
+    """Drop raw samples and hourly rows already folded into the rollups, and counters of deleted subscriptions."""
+    async with writer('compact_traffic') as db:
+        samples = await db.execute('DELETE FROM traffic_samples WHERE ts < ?', (samples_before_ts,))
+        hourly = await db.execute('DELETE FROM traffic_hourly WHERE hour < ?', (hourly_before_ts // 3600,))
+        await db.execute(
+            'DELETE FROM traffic_counters WHERE sub_id NOT IN (SELECT id FROM subscriptions)')
+        return samples.rowcount, hourly.rowcount
+
+async def get_traffic_usage(sub_ids, since_ts):
+    """Return {sub_id: bytes} transferred since the start of the hour of since_ts, from the hourly rollup.
+
+    since_ts must be within the hourly retention; older traffic is only in the daily rollup.
+    """
+    async with reader('get_traffic_usage') as db:
+        rows = await db.execute_fetchall('''
+            SELECT sub_id, SUM(bytes) FROM traffic_hourly
+            WHERE sub_id IN (SELECT value FROM json_each(?)) AND hour >= ?
+            GROUP BY sub_id
+        ''', (json.dumps(list(sub_ids)), since_ts // 3600))
+    return dict(rows)
+
+async def save_payment_notification(operation_id, payload):
+    """Put a verified notification into the inbox; returns False if it was already there."""
+    now = int(time.time())
+    async with writer('save_payment_notification') as db:
+        cursor = await db.execute('''
+            INSERT OR IGNORE INTO payment_inbox (operation_id, payload, next_attempt_at, received_at)
+            VALUES (?, ?, ?, ?)
+        ''', (operation_id, json.dumps(payload), now, now))
+        return cursor.rowcount > 0
+
+async def get_due_payments(now_ts, limit=20):
+    """Return (operation_id, payload, attempts) of pending notifications whose next attempt is due."""
+    async with reader('get_due_payments') as db:
+        rows = await db.execute_fetchall('''
+            SELECT operation_id, payload, attempts FROM payment_inbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        ''', (now_ts, limit))
+    return [(operation_id, json.loads(payload), attempts) for operation_id, payload, attempts in rows]
+
+async def get_next_payment_attempt():
+    async with reader('get_next_payment_attempt') as db:
+        rows = await db.execute_fetchall(
+            "SELECT MIN(next_attempt_at) FROM payment_inbox WHERE status = 'pending'")
+        return rows[0][0]
+
+async def retry_payment(operation_id, attempts, next_attempt_at, error):
+    async with writer('retry_payment') as db:
+        await db.execute('''
+            UPDATE payment_inbox SET attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE operation_id = ? AND status = 'pending'
+        ''', (attempts, next_attempt_at, error, operation_id))
+
+async def finish_payment(operation_id, status, error=None):
+    async with writer('finish_payment') as db:
+        await db.execute('''
+            UPDATE payment_inbox SET status = ?, last_error = ?, processed_at = ?
+            WHERE operation_id = ? AND status = 'pending'
+        ''', (status, error, int(time.time()), operation_id))
+
+async def get_fsm_record(key):
+    """Return (state, data) stored for an FSM key; data is a dict."""
+    async with reader('get_fsm_record') as db:
+        rows = await db.execute_fetchall('SELECT state, data FROM fsm_state WHERE key = ?', (key,))
+    if not rows:
+        return None, {}
+    state, data = rows[0]
+    return state, json.loads(data) if data else {}
+
+async def set_fsm_state(key, state):
+    async with writer('set_fsm_state') as db:
+        await db.execute('''
+            INSERT INTO fsm_state (key, state) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state
+        ''', (key, state))
+        # A key with neither state nor data needs no row
+        await db.execute('DELETE FROM fsm_state WHERE key = ? AND state IS NULL AND data IS NULL', (key,))
+
+async def set_fsm_data(key, data):
+    async with writer('set_fsm_data') as db:
+        await db.execute('''
+            INSERT INTO fsm_state (key, data) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET data = excluded.data
+        ''', (key, json.dumps(data, ensure_ascii=False) if data else None))
+        await db.execute('DELETE FROM fsm_state WHERE key = ? AND state IS NULL AND data IS NULL', (key,))
+
+async def acquire_lease(name, holder, ttl):
+    """Take or renew the named lease for ttl seconds; returns False while another holder's lease is valid."""
+    now = time.time()
+    async with writer('acquire_lease') as db:
+        rows = await db.execute_fetchall('''
+            INSERT INTO leases (name, holder, expires_at) VALUES (?1, ?2, ?3)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?4
+            RETURNING holder
+        ''', (name, holder, now + ttl, now))
+    return bool(rows)
+
+async def release_lease(name, holder):
+    async with writer('release_lease') as db:
+        await db.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
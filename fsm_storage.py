@@ -0,0 +1,61 @@
+# fsm_storage.py
+import os
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from cache import TTLCache
+from db import get_fsm_record, set_fsm_data, set_fsm_state
+
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))  # FSM records kept in memory per process
+FSM_CACHE_TTL = 600  # Seconds a cached record is trusted
+
+
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage in the shared SQLite database.
+
+    aiogram reads the state on every update, so records are cached in memory and writes
+    go through to the database. The cache is safe because all updates of one user are
+    handled by the same process (see cluster.py); after a restart with another number of
+    workers the records are read from the database again.
+    """
+
+    def __init__(self, key_builder=None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = TTLCache(FSM_CACHE_SIZE, FSM_CACHE_TTL)
+
+    async def _record(self, key):
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            generation = self._cache.generation
+            record = await get_fsm_record(storage_key)
+            self._cache.set(storage_key, record, generation)
+        return storage_key, record
+
+    def _remember(self, storage_key, record):
+        # Invalidating first discards a read of the old record that is still in flight
+        self._cache.invalidate(storage_key)
+        self._cache.set(storage_key, record)
+
+    async def set_state(self, key, state=None):
+        storage_key, (_, data) = await self._record(key)
+        state = state.state if isinstance(state, State) else state
+        await set_fsm_state(storage_key, state)
+        self._remember(storage_key, (state, data))
+
+    async def get_state(self, key):
+        _, (state, _) = await self._record(key)
+        return state
+
+    async def set_data(self, key, data):
+        storage_key, (state, _) = await self._record(key)
+        await set_fsm_data(storage_key, data)
+        self._remember(storage_key, (state, dict(data)))
+
+    async def get_data(self, key):
+        _, (_, data) = await self._record(key)
+        return dict(data)
+
+    async def close(self):
+        self._cache.clear()
@@ -0,0 +1,128 @@
+# key_pool.py
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+from db import TrialAlreadyUsed, add_pooled_key, claim_pooled_key, count_pooled_keys, save_subscription
+from vpn_manager import create_vpn_key_with_name, get_manager
+
+KEY_POOL_LOW = int(os.getenv('KEY_POOL_LOW', '5'))  # Refill when fewer keys than this are left
+KEY_POOL_HIGH = int(os.getenv('KEY_POOL_HIGH', '20'))  # Refill up to this many keys
+KEY_POOL_CONCURRENCY = int(os.getenv('KEY_POOL_CONCURRENCY', '4'))  # Parallel create calls while refilling
+KEY_POOL_CHECK_INTERVAL = 60  # Seconds between pool checks when nothing is claimed
+
+_refill_requested = asyncio.Event()
+_refill_listeners = []
+_background_tasks = set()
+
+
+def add_refill_listener(callback):
+    """Register callback() called when a claim in this process asks for a pool refill."""
+    _refill_listeners.append(callback)
+
+
+def remove_refill_listener(callback):
+    _refill_listeners.remove(callback)
+
+
+def request_refill():
+    """Wake maintain_key_pool; called after local claims and for claims relayed from cluster workers.
+
+    maintain_key_pool runs only in the lease holder, so cluster workers relay the request
+    to the ingress through a listener. A lease holder in another process still picks the
+    claim up on its next check, KEY_POOL_CHECK_INTERVAL at most.
+    """
+    _refill_requested.set()
+    for callback in _refill_listeners:
+        try:
+            callback()
+        except Exception as e:
+            logging.error("Refill listener failed: %s", e)
+
+
+def _user_key_name(user_id):
+    return f"User_{user_id}_{datetime.now(timezone.utc).isoformat()}"
+
+
+async def _rename_claimed_key(server, key_id, user_id):
+    try:
+        await get_manager().rename_key(server, key_id, _user_key_name(user_id))
+    except Exception as e:
+        # The key works regardless of its name, so this is not fatal
+        logging.error("Error renaming pooled key %s for user %s: %s", key_id, user_id, e)
+
+
+async def provision_key(user_id, duration_days, rename_in_background=True, server=None, payment=None, trial=False):
+    """Create a subscription for the user, preferring an already created key from the pool.
+
+    Without a server the key comes from any pooled server or the least loaded one.
+    A payment, or the use of the trial, is recorded in the same transaction as the subscription.
+    Returns key_data ({'id', 'accessUrl', 'server'}) or None if no key could be created.
+    Raises TrialAlreadyUsed if trial is set and the user has had one.
+    """
+    claimed = await claim_pooled_key(user_id, duration_days, server, payment, trial)
+    if claimed:
+        _, key_data = claimed
+        request_refill()
+        if rename_in_background:
+            task = asyncio.create_task(_rename_claimed_key(key_data['server'], key_data['id'], user_id))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        else:
+            await _rename_claimed_key(key_data['server'], key_data['id'], user_id)
+        return key_data
+
+    logging.warning("Key pool is empty, creating a key for user %s directly", user_id, extra={'user_id': user_id})
+    key_data = await create_vpn_key_with_name(user_id, server)
+    if not key_data:
+        return None
+    try:
+        await save_subscription(user_id, key_data, duration_days, payment, trial)
+    except Exception as e:
+        if not isinstance(e, TrialAlreadyUsed):
+            logging.error("Error saving subscription for user %s: %s", user_id, e, extra={'user_id': user_id})
+        # Do not leave a key without a subscription on the server
+        try:
+            await get_manager().delete_key(key_data['server'], key_data['id'])
+        except Exception as delete_exception:
+            logging.error("Error deleting key %s: %s", key_data['id'], delete_exception)
+        if isinstance(e, TrialAlreadyUsed):
+            raise
+        return None
+    return key_data
+
+
+async def _create_pool_key(semaphore):
+    async with semaphore:
+        try:
+            key = await get_manager().create_key(name=f"Pool_{datetime.now(timezone.utc).isoformat()}")
+            await add_pooled_key(key)
+            return True
+        except Exception as e:
+            logging.error("Error creating pooled key: %s", e)
+            return False
+
+
+async def refill_key_pool():
+    available = await count_pooled_keys()
+    if available >= KEY_POOL_LOW:
+        return 0
+    semaphore = asyncio.Semaphore(KEY_POOL_CONCURRENCY)
+    results = await asyncio.gather(*(_create_pool_key(semaphore) for _ in range(KEY_POOL_HIGH - available)))
+    created = sum(results)
+    logging.info("Key pool refilled: %s -> %s", available, available + created)
+    return created
+
+
+async def maintain_key_pool():
+    while True:
+        try:
+            await refill_key_pool()
+        except Exception as e:
+            logging.error("Error refilling key pool: %s", e)
+        _refill_requested.clear()
+        try:
+            await asyncio.wait_for(_refill_requested.wait(), timeout=KEY_POOL_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,130 @@
+# log_setup.py
+import atexit
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.getenv('LOG_JSON', '').lower() in ('1', 'true', 'yes')  # JSON lines instead of plain text
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # Rotate when the file grows past this
+LOG_ROTATE_INTERVAL = int(os.getenv('LOG_ROTATE_INTERVAL', '86400'))  # And at the start of every such period (UTC)
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '7'))
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields passed as extra={...} that are written as separate JSON keys
+STRUCTURED_FIELDS = ('user_id', 'sub_id', 'key_id', 'server', 'operation_id', 'job_id', 'latency_ms')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SharedRotatingFileHandler(logging.FileHandler):
+    """File handler that several processes can share.
+
+    Every write holds an flock on "<file>.lock". Under the lock the handler reopens the
+    file if another process has rotated it, and rotates it itself when it is larger than
+    max_bytes or was last written in an earlier rotation period.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_INTERVAL,
+                 backup_count=LOG_BACKUP_COUNT, encoding='utf-8'):
+        super().__init__(filename, mode='a', encoding=encoding)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self._lock_file = open(f"{self.baseFilename}.lock", 'a')
+
+    def _reopen_if_rotated(self):
+        try:
+            current_inode = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            current_inode = None
+        if self.stream is None or current_inode != os.fstat(self.stream.fileno()).st_ino:
+            if self.stream is not None:
+                self.stream.close()
+            self.stream = self._open()
+
+    def _should_rotate(self, pending_bytes):
+        stat = os.fstat(self.stream.fileno())
+        if stat.st_size == 0:
+            return False
+        if self.max_bytes and stat.st_size + pending_bytes > self.max_bytes:
+            return True
+        return bool(self.interval) and stat.st_mtime // self.interval < time.time() // self.interval
+
+    def _rotate(self):
+        self.stream.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.baseFilename}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.baseFilename}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.baseFilename, f"{self.baseFilename}.1")
+        else:
+            os.remove(self.baseFilename)
+        self.stream = self._open()
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + self.terminator
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._reopen_if_rotated()
+                if self._should_rotate(len(message.encode(self.encoding or 'utf-8'))):
+                    self._rotate()
+                self.stream.write(message)
+                self.stream.flush()
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        super().close()
+        self._lock_file.close()
+
+
+def setup_logging(log_file=LOG_FILE, level=LOG_LEVEL, json_lines=LOG_JSON):
+    """Send all records through a queue to a background thread that writes the file and console.
+
+    Logging calls on the event loop only put the record into the queue.
+    """
+    formatter = JsonFormatter() if json_lines else logging.Formatter(LOG_FORMAT)
+    file_handler = SharedRotatingFileHandler(log_file)  # Логи записываются в файл bot.log
+    console_handler = logging.StreamHandler()  # Логи продолжают выводиться в консоль
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                              respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
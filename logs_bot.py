@@ -1,34 +1,25 @@
 import asyncio
-import aiosqlite
+import json
 import os
 import logging
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
-from datetime import datetime
-from dotenv import load_dotenv
-load_dotenv()
 
-# Инициализация бота
-TELEGRAM_BOT_TOKEN_LOGGER = os.getenv("TELEGRAM_BOT_TOKEN_LOGGER")
-CHAT_ID = os.getenv("CHAT_ID")  # Ваш user_id для уведомлений
-LOG_FILE = "./bot.log"  # Путь к файлу лога
+from settings import CHAT_ID, TELEGRAM_BOT_TOKEN_LOGGER  # Первым: читает .env до настроек log_setup
+from log_setup import LOG_FILE, setup_logging
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN_LOGGER)
-dp = Dispatcher(storage=MemoryStorage())
+# Бот создается при запуске, а не при импорте: импорт не требует токена
+router = Router()
+_bot = None
 
-logging.getLogger('aiogram.event').setLevel(logging.WARNING)
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,  # Уровень логирования
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-    handlers=[
-        logging.FileHandler('bot.log'),  # Логи записываются в файл bot.log
-        logging.StreamHandler()  # Логи продолжают выводиться в консоль
-    ]
-)
-logging.info("Бот запущен")
+def get_bot():
+    global _bot
+    if _bot is None:
+        _bot = Bot(token=TELEGRAM_BOT_TOKEN_LOGGER)
+    return _bot
 
 
 # Проверка доступа к боту
@@ -38,7 +29,7 @@ def is_authorized_user(user_id):
     return user_id == AUTHORIZED_USER_ID
 
 # Обработчик команды /start
-@dp.message(Command("start"))
+@router.message(Command("start"))
 async def start(message: types.Message):
     if is_authorized_user(message.from_user.id):
         await message.answer("Привет, вы авторизованы для использования этого бота!")
@@ -46,30 +37,181 @@ async def start(message: types.Message):
         await message.answer("Извините, у вас нет доступа к этому боту.")
 
 # Мониторинг файла лога
-async def monitor_logs():
-    async def send_telegram_message(text):
-        """Функция для отправки уведомления в Telegram."""
+LOG_FORWARD_LEVEL = logging.getLevelName(os.getenv("LOG_FORWARD_LEVEL", "INFO").upper())  # Минимальный уровень
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "5"))  # Секунд между отправками пачек
+LOG_POLL_INTERVAL = 0.2  # Секунд между чтениями файла
+LOG_READ_CHUNK = 1024 * 1024  # Байт за одно чтение
+LOG_MAX_ENTRIES = 500  # Разных записей за один интервал, остальные только считаются
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class LogTailer:
+    """Reads complete new lines from a log file, following rotation and truncation by inode."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.partial = b''
+
+    def _open(self, from_end):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.partial = b''
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def _read_available(self):
+        chunks = []
+        while True:
+            chunk = self.file.read(LOG_READ_CHUNK)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def read_lines(self):
+        if self.file is None:
+            try:
+                # Переход к концу файла, чтобы не отправлять старые записи
+                self._open(from_end=True)
+            except FileNotFoundError:
+                return []
+        data = self.partial + self._read_available()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_ino != self.inode:
+            # Файл ротирован: дочитываем старый и открываем новый с начала
+            data += self._read_available()
+            if data and not data.endswith(b'\n'):
+                data += b'\n'
+            self._open(from_end=False)
+            data += self._read_available()
+        elif stat is not None and stat.st_size < self.file.tell():
+            # Файл обрезан
+            self.file.seek(0)
+            data = self._read_available()
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        return [line.decode('utf-8', errors='replace') for line in lines]
+
+
+class LogAggregator:
+    """Groups log records of one flush interval, counting identical ones."""
+
+    def __init__(self, min_level):
+        self.min_level = min_level
+        self.entries = {}  # (level, name, message) -> [first time, count, continuation lines]
+        self.dropped = 0
+        self._last_key = None
+
+    def add_lines(self, lines):
+        for line in lines:
+            parts = self._parse(line)
+            level = logging.getLevelName(parts[2]) if parts else None
+            if not isinstance(level, int):
+                # Продолжение предыдущей записи, например строки трейсбека
+                entry = self.entries.get(self._last_key)
+                if entry is not None and entry[1] == 1 and line.strip():
+                    entry[2].append(line)
+                continue
+            if level < self.min_level:
+                self._last_key = None
+                continue
+            key = (parts[2], parts[1], parts[3])
+            if key in self.entries:
+                self.entries[key][1] += 1
+            elif len(self.entries) < LOG_MAX_ENTRIES:
+                self.entries[key] = [parts[0], 1, []]
+            else:
+                self.dropped += 1
+                key = None
+            self._last_key = key
+
+    @staticmethod
+    def _parse(line):
+        # Строка JSON (LOG_JSON=1) или формат '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+                return entry['ts'], entry['logger'], entry['level'], entry['message']
+            except (ValueError, KeyError):
+                return None
+        parts = line.split(' - ', 3)
+        return parts if len(parts) == 4 else None
+
+    def drain(self):
+        texts = []
+        for (level, name, message), (first_time, count, continuation) in self.entries.items():
+            suffix = f" (x{count})" if count > 1 else ""
+            texts.append("\n".join([f"{first_time} {level} {name}: {message}{suffix}", *continuation]))
+        if self.dropped:
+            texts.append(f"... и еще {self.dropped} записей")
+        self.entries = {}
+        self.dropped = 0
+        self._last_key = None
+        return texts
+
+
+def pack_messages(texts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Join log entries into as few messages as possible, each within the Telegram limit."""
+    messages = []
+    current = ""
+    for text in texts:
+        if len(text) > limit:
+            text = text[:limit - 1] + "…"
+        if current and len(current) + 1 + len(text) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{text}" if current else text
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def send_telegram_message(text):
+    """Функция для отправки уведомления в Telegram."""
+    for _ in range(3):
         try:
-            await bot.send_message(CHAT_ID, text)
+            await get_bot().send_message(CHAT_ID, text)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
         except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения в Telegram: {e}")
+            logging.error("Ошибка при отправке сообщения в Telegram: %s", e)
+            return
 
-    logging.info("Начат мониторинг файла лога.")
-    with open(LOG_FILE, 'r') as f:
-        # Переход к концу файла, чтобы не отправлять старые записи
-        f.seek(0, os.SEEK_END)
 
-        while True:
-            line = f.readline()
-            if line:
-                if "ERROR" in line or "INFO" in line or "WARNING" in line or "WARN" in line:
-                    await send_telegram_message(f"Новое сообщение в логе: {line.strip()}")
-            await asyncio.sleep(1)
+async def monitor_logs():
+    logging.info("Начат мониторинг файла лога.")
+    tailer = LogTailer(LOG_FILE)
+    aggregator = LogAggregator(LOG_FORWARD_LEVEL)
+    loop = asyncio.get_running_loop()
+    next_flush = loop.time() + LOG_FLUSH_INTERVAL
+    while True:
+        try:
+            aggregator.add_lines(tailer.read_lines())
+        except OSError as e:
+            logging.error("Ошибка при чтении файла лога: %s", e)
+        if loop.time() >= next_flush:
+            for message in pack_messages(aggregator.drain()):
+                await send_telegram_message(message)
+            next_flush = loop.time() + LOG_FLUSH_INTERVAL
+        await asyncio.sleep(LOG_POLL_INTERVAL)
 
 # Запуск бота и мониторинга логов
 async def main():
+    # Настройка логирования: тот же файл, что и у основного бота, с общей блокировкой ротации
+    setup_logging()
+    logging.info("Бот запущен")
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
     asyncio.create_task(monitor_logs())  # Запуск мониторинга логов
-    await dp.start_polling(bot)
+    await dp.start_polling(get_bot())
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,212 @@
+# loop_monitor.py
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from aiohttp import web
+
+from metrics import METRICS_TOKEN, Counter, Histogram, check_token
+
+LOOP_MONITOR = os.getenv('LOOP_MONITOR', '1').lower() in ('1', 'true', 'yes')  # Always on unless disabled
+LOOP_SLOW_CALLBACK = float(os.getenv('LOOP_SLOW_CALLBACK', '0.1'))  # Seconds one callback may block the loop
+LOOP_STALL_SECONDS = 5  # A callback running this long is reported while it still blocks the loop
+LOOP_LAG_INTERVAL = 0.25  # Seconds between scheduling lag samples
+LOOP_SUMMARY_INTERVAL = int(os.getenv('LOOP_SUMMARY_INTERVAL', '300'))  # Seconds between summaries in the log
+LOOP_SLOW_HISTORY = 50  # Slow callbacks kept for /debug/loop
+LOOP_STACK_DEPTH = 30  # Frames kept per stack
+
+# Label of the work running in the current context: "handler:<name>", "job:<name>" or "other"
+activity = contextvars.ContextVar('activity', default='other')
+
+loop_lag_seconds = Histogram('hrvpn_loop_lag_seconds', "Delay between a timer's due time and its callback")
+loop_busy_seconds = Counter('hrvpn_loop_busy_seconds_total', "Event loop time spent in callbacks by activity",
+                            ('activity',))
+loop_slow_callbacks = Counter('hrvpn_loop_slow_callbacks_total',
+                              "Callbacks that blocked the event loop longer than LOOP_SLOW_CALLBACK",
+                              ('activity',))
+
+
+def create_task(coro, label):
+    """Start a task whose callbacks, including those of tasks it spawns, count towards label."""
+    context = contextvars.copy_context()
+    context.run(activity.set, label)
+    return asyncio.create_task(coro, name=label, context=context)
+
+
+def _describe(handle):
+    callback = handle._callback
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        frame = getattr(coro, 'cr_frame', None)
+        where = f" at {frame.f_code.co_filename}:{frame.f_lineno}" if frame is not None else ''
+        return f"task {task.get_name()} {getattr(coro, '__qualname__', coro)}{where}"
+    return repr(getattr(callback, '__func__', callback))
+
+
+class LoopMonitor:
+    """Measures how long the event loop is blocked and by what.
+
+    Handle._run is wrapped to time every callback on the monitored loop and charge it to
+    the current activity. A watchdog thread takes the loop thread's stack while a slow
+    callback is still running, so the report shows the blocking code rather than where
+    the coroutine resumed. A sampler task measures timer lag for the overall picture.
+    """
+
+    def __init__(self, slow_callback=LOOP_SLOW_CALLBACK):
+        self.slow_callback = slow_callback
+        self.slow = deque(maxlen=LOOP_SLOW_HISTORY)
+        self._thread_id = None
+        self._running = None  # (handle, started) of the callback running now
+        self._captured = None  # (handle, stack) taken by the watchdog
+        self._stop = threading.Event()
+        self._watchdog = None
+        self._tasks = []
+        self._lags = []  # Lag samples since the last summary
+        self._slow_count = 0  # Slow callbacks since the last summary
+        self._busy_at_summary = {}
+        self._original_run = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._original_run = asyncio.events.Handle._run
+        monitor = self
+
+        def _run(handle):
+            if threading.get_ident() != monitor._thread_id:
+                return monitor._original_run(handle)
+            # A step that sets the label is charged to it, one that resets it to the label it started with.
+            # Context.get ignores the ContextVar default: None means the label was not set before the step
+            label = handle._context.get(activity)
+            started = time.perf_counter()
+            monitor._running = (handle, started)
+            try:
+                return monitor._original_run(handle)
+            finally:
+                monitor._running = None
+                if label is None:
+                    label = handle._context.get(activity, 'other')
+                monitor._account(handle, label, time.perf_counter() - started)
+
+        asyncio.events.Handle._run = _run
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        self._tasks = [create_task(self._sample_lag(), 'monitor:lag'),
+                       create_task(self._log_summaries(), 'monitor:summary')]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._stop.set()
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def _account(self, handle, label, elapsed):
+        loop_busy_seconds.inc(label, amount=elapsed)
+        if elapsed < self.slow_callback:
+            return
+        captured = self._captured
+        stack = captured[1] if captured is not None and captured[0] is handle else None
+        self._captured = None
+        loop_slow_callbacks.inc(label)
+        self._slow_count += 1
+        entry = {
+            'at': time.time(),
+            'duration': round(elapsed, 4),
+            'activity': label,
+            'callback': _describe(handle),
+            'stack': stack,
+        }
+        self.slow.append(entry)
+        logging.warning("Цикл событий заблокирован на %.3f с (%s): %s%s", elapsed, label, entry['callback'],
+                        ''.join(['\n'] + stack) if stack else '',
+                        extra={'latency_ms': round(elapsed * 1000)})
+
+    def _stack(self):
+        frame = sys._current_frames().get(self._thread_id)
+        return traceback.format_stack(frame, limit=LOOP_STACK_DEPTH) if frame is not None else None
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.slow_callback / 2):
+            running = self._running
+            if running is None:
+                continue
+            handle, started = running
+            blocked = time.perf_counter() - started
+            if blocked < self.slow_callback:
+                continue
+            if self._captured is None or self._captured[0] is not handle:
+                self._captured = (handle, self._stack())
+            if blocked >= LOOP_STALL_SECONDS and reported is not handle:
+                reported = handle
+                logging.error("Цикл событий заблокирован уже %.1f с (%s):\n%s", blocked,
+                              handle._context.get(activity, 'other'), ''.join(self._captured[1] or ()))
+
+    async def _sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            loop_lag_seconds.observe(lag)
+            self._lags.append(lag)
+
+    def _busy(self):
+        return {labels[0]: value for labels, value in loop_busy_seconds.values().items()}
+
+    def stats(self):
+        lags = sorted(self._lags)
+        busy = sorted(self._busy().items(), key=lambda item: item[1], reverse=True)
+        return {
+            'lag_ms': {
+                'samples': len(lags),
+                'p50': round(lags[len(lags) // 2] * 1000, 1) if lags else None,
+                'p99': round(lags[int(len(lags) * 0.99)] * 1000, 1) if lags else None,
+                'max': round(lags[-1] * 1000, 1) if lags else None,
+            },
+            'busy_seconds': {label: round(seconds, 3) for label, seconds in busy},
+            'slow_callback_threshold': self.slow_callback,
+            'slow_callbacks': list(self.slow),
+        }
+
+    async def _log_summaries(self):
+        while True:
+            await asyncio.sleep(LOOP_SUMMARY_INTERVAL)
+            stats = self.stats()
+            busy = self._busy()
+            interval = {label: seconds - self._busy_at_summary.get(label, 0.0) for label, seconds in busy.items()}
+            self._busy_at_summary = busy
+            self._lags = []
+            slow, self._slow_count = self._slow_count, 0
+            top = sorted(interval.items(), key=lambda item: item[1], reverse=True)[:5]
+            lag = stats['lag_ms']
+            logging.info("Цикл событий за %s с: задержка p50 %s мс, p99 %s мс, max %s мс; медленных вызовов %s; "
+                         "больше всего времени: %s", LOOP_SUMMARY_INTERVAL, lag['p50'], lag['p99'], lag['max'], slow,
+                         ', '.join(f"{label} {seconds:.2f} с" for label, seconds in top))
+
+
+monitor = LoopMonitor()
+
+
+async def loop_handler(request):
+    check_token(request)
+    return web.json_response(monitor.stats())
+
+
+def setup_loop_monitor(app):
+    # Slow callback entries carry stack traces of the bot's code, so they are never served without a token
+    if not METRICS_TOKEN:
+        logging.warning("METRICS_TOKEN is not set, /debug/loop is not mounted")
+        return
+    app.router.add_get('/debug/loop', loop_handler)
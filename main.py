@@ -1,46 +1,103 @@
 # main.py
+from startup import startup_profile  # Первым: отсчет времени запуска начинается до тяжелых импортов
+
 import asyncio
 import logging
 
 from aiohttp import web
-from dotenv import load_dotenv
-load_dotenv()
 
-from telegram_bot import dp, bot
-from db import init_db
+import settings  # Читает .env до того, как модули ниже прочитают свои настройки
+from telegram_bot import get_bot, get_dispatcher, yoomoney_notification
+from db import init_db, close_db
 from tasks import check_subscriptions, sync_keys
-from telegram_bot import yoomoney_notification
-
+from key_pool import maintain_key_pool
+from broadcasts import run_broadcast_worker
+from traffic import run_traffic_collector
+from payments import run_payment_worker
+from admin_app import setup_admin
+from metrics import setup_metrics
+from loop_monitor import LOOP_MONITOR, monitor as loop_monitor, setup_loop_monitor
+from telegram_webhook import TELEGRAM_MODE, run_polling, setup_telegram_webhook, start_webhook
+from cluster import CLUSTER_WORKERS, ClusterIngress, run_as_leader
+from outbound import dispatcher as outbound_dispatcher
+from vpn_manager import close_manager
 
-logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+from log_setup import setup_logging
 
-logging.basicConfig(
-    level=logging.INFO,  # Уровень логирования
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Формат сообщения
-    handlers=[
-        logging.FileHandler('bot.log'),  # Логи записываются в файл bot.log
-        logging.StreamHandler()  # Логи продолжают выводиться в консоль
-    ]
+# Фоновые задачи выполняет только один процесс, владеющий арендой в базе
+BACKGROUND_JOBS = (
+    check_subscriptions,
+    sync_keys,
+    maintain_key_pool,
+    run_broadcast_worker,
+    run_traffic_collector,
+    run_payment_worker,
 )
 
-logging.info("Бот запущен")
 
-app = web.Application()
-app.router.add_post('/yoomoney_notification', yoomoney_notification)
+def create_app(dp, bot):
+    """Build the aiohttp app; returns it with the cluster ingress, or None without workers."""
+    app = web.Application()
+    app.router.add_post('/yoomoney_notification', yoomoney_notification)
+    setup_admin(app)  # Админ-панель /admin/* в том же процессе, что и бот
+    setup_metrics(app)  # /metrics в формате Prometheus и время обработки HTTP-запросов
+    setup_loop_monitor(app)  # /debug/loop: задержки цикла событий и медленные обратные вызовы
+    ingress = None
+    if CLUSTER_WORKERS:
+        # Обновления распределяются по процессам-воркерам, этот процесс только принимает вебхук
+        if TELEGRAM_MODE != 'webhook':
+            raise RuntimeError("CLUSTER_WORKERS requires TELEGRAM_MODE=webhook")
+        ingress = ClusterIngress(CLUSTER_WORKERS)
+        ingress.setup(app)
+    elif TELEGRAM_MODE == 'webhook':
+        setup_telegram_webhook(app, dp, bot)  # Обновления Telegram приходят на тот же порт, что и ЮMoney
+    return app, ingress
 
 
 async def main():
+    startup_profile.mark('imports')
+    if LOOP_MONITOR:
+        loop_monitor.start()
+    bot = get_bot()
+    dp = get_dispatcher()
+    app, ingress = create_app(dp, bot)
     await init_db()
-    asyncio.create_task(check_subscriptions())
-    asyncio.create_task(sync_keys())
+    startup_profile.mark('init_db')
+    outbound_dispatcher.start(bot)
+    leader = asyncio.create_task(run_as_leader(BACKGROUND_JOBS))
+    if ingress is not None:
+        await ingress.start()
+        startup_profile.mark('cluster')
 
     runner = web.AppRunner(app)
     await runner.setup()
 
     site = web.TCPSite(runner, '0.0.0.0', 8080)
     await site.start()
+    startup_profile.mark('http')
 
-    await dp.start_polling(bot)
+    try:
+        if TELEGRAM_MODE == 'webhook':
+            await start_webhook(dp, bot)
+            startup_profile.mark('webhook')
+            startup_profile.report()
+            await asyncio.Event().wait()
+        else:
+            startup_profile.report()
+            await run_polling(dp, bot)
+    finally:
+        await runner.cleanup()
+        if ingress is not None:
+            await ingress.stop()
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        await outbound_dispatcher.stop()
+        await close_manager()
+        await close_db()
+        await loop_monitor.stop()
 
 if __name__ == "__main__":
+    # Запись логов идет в отдельном потоке, цикл событий только кладет записи в очередь
+    setup_logging()
+    logging.info("Бот запущен")
     asyncio.run(main())
@@ -0,0 +1,190 @@
+# metrics.py
+import bisect
+import hmac
+import logging
+import math
+import os
+import time
+
+from aiohttp import web
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # /metrics requires "Authorization: Bearer <token>"; unset disables it
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(labelnames, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        """{labels: value} for every series counted so far."""
+        return dict(self._values)
+
+    def render(self):
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels_text(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def clear(self):
+        self._values = {}
+
+    render = Counter.render
+
+
+class Histogram(_Metric):
+    """Histogram with fixed buckets; observe() increments one bucket and the sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def totals(self):
+        """{labels: (count, sum)} for every series observed so far."""
+        return {labels: (sum(entry[:-1]), entry[-1]) for labels, entry in self._values.items()}
+
+    def render(self):
+        lines = self._header()
+        for labels, entry in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), entry):
+                cumulative += count
+                le = _labels_text(self.labelnames, labels, (('le', _number(bound)),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_text = _labels_text(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_number(entry[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def add_collector(callback):
+    """Register an async callback run on every scrape, used to refresh gauges."""
+    _collectors.append(callback)
+
+
+async def render_metrics():
+    for callback in _collectors:
+        await callback()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def check_token(request):
+    """Reject requests without the METRICS_TOKEN bearer token; used by every diagnostics endpoint."""
+    expected = f"Bearer {METRICS_TOKEN}".encode()
+    if not METRICS_TOKEN or not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+        raise web.HTTPUnauthorized()
+
+
+async def metrics_handler(request):
+    check_token(request)
+    body = (await render_metrics()).encode()
+    return web.Response(body=body, headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+http_request_seconds = Histogram('hrvpn_http_request_seconds', "HTTP request processing time by route",
+                                 ('route', 'status'))
+
+
+@web.middleware
+async def http_metrics_middleware(request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        # The route template keeps ids in paths from creating a series per request
+        name = route.canonical if route is not None else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started, name, str(status))
+
+
+def setup_metrics(app):
+    app.middlewares.append(http_metrics_middleware)
+    # The app also serves the public webhooks, and a scrape runs aggregate queries on the database
+    if not METRICS_TOKEN:
+        logging.warning("METRICS_TOKEN is not set, /metrics is not mounted")
+        return
+    app.router.add_get('/metrics', metrics_handler)
@@ -0,0 +1,246 @@
+# outbound.py
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+
+from metrics import Gauge, Histogram, add_collector
+
+PRIORITY_TRANSACTIONAL = 0  # Keys, payment confirmations, replies to button presses
+PRIORITY_BULK = 1  # Expiry reminders, broadcasts
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # Messages per second for the whole bot
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # Messages per second for one chat
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '5'))  # Messages one chat may get at once
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))  # Concurrent send_message calls
+OUTBOUND_MAX_RETRIES = 5  # Attempts per message after a 429
+
+outbound_send_seconds = Histogram('hrvpn_outbound_send_seconds', "Telegram send_message call latency",
+                                  ('priority', 'result'))
+outbound_queue_wait_seconds = Histogram('hrvpn_outbound_queue_wait_seconds',
+                                        "Time a message waited in the outbound queue", ('priority',))
+outbound_gauge = Gauge('hrvpn_outbound', "Outbound dispatcher counters", ('stat',))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until one token is available."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def time_until_full(self):
+        self._refill()
+        return (self.capacity - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class _OutboundMessage:
+    __slots__ = ('text', 'kwargs', 'priority', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, text, kwargs, priority, future):
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class _ChatQueue:
+    __slots__ = ('messages', 'bucket', 'active')
+
+    def __init__(self, bucket):
+        self.messages = deque()
+        self.bucket = bucket
+        self.active = False  # Scheduled in the ready queue or being sent by a worker
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.warning("Не удалось отправить сообщение: %s", future.exception())
+
+
+class OutboundDispatcher:
+    """Queue for outgoing Telegram messages with global and per-chat rate limits.
+
+    Messages to one chat are delivered in order, one at a time. Chats with pending
+    messages wait in a priority queue, so transactional messages overtake bulk ones,
+    and a pool of workers sends them while honoring Telegram's retry_after.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, workers=OUTBOUND_WORKERS):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.worker_count = workers
+        self.bot = None
+        self._chats = {}
+        self._ready = None
+        self._workers = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._stats = {
+            'queued': 0, 'sent': 0, 'failed': 0, 'retry_after': 0,
+            'send_time_total': 0.0, 'send_time_max': 0.0,
+            'queue_wait_total': 0.0, 'queue_wait_max': 0.0,
+        }
+
+    def set_global_rate(self, rate):
+        """Change the whole-bot limit, e.g. to this process's share when several processes send."""
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def start(self, bot):
+        self.bot = bot
+        self._ready = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self, drain=True):
+        if drain:
+            while self._stats['queued'] and self._workers:
+                await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def send(self, chat_id, text, priority=PRIORITY_TRANSACTIONAL, **kwargs):
+        """Queue a message; returns a future resolved with the sent Message."""
+        if not self._workers:
+            raise RuntimeError("Outbound dispatcher is not started")
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.messages.append(_OutboundMessage(text, kwargs, priority, future))
+        self._stats['queued'] += 1
+        if not chat.active:
+            chat.active = True
+            self._schedule(chat_id, chat, chat.bucket.delay())
+        return future
+
+    def _schedule(self, chat_id, chat, delay):
+        entry = (chat.messages[0].priority, next(self._seq), chat_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, entry)
+        else:
+            self._ready.put_nowait(entry)
+
+    def _forget_idle_chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None and not chat.active and chat.bucket.time_until_full() <= 0:
+            del self._chats[chat_id]
+
+    def _finish(self, chat_id, chat):
+        if chat.messages:
+            self._schedule(chat_id, chat, chat.bucket.delay())
+        else:
+            chat.active = False
+            asyncio.get_running_loop().call_later(
+                chat.bucket.time_until_full() + 0.1, self._forget_idle_chat, chat_id)
+
+    async def _acquire_global(self):
+        while True:
+            delay = max(self._paused_until - time.monotonic(), self.global_bucket.delay())
+            if delay <= 0:
+                self.global_bucket.consume()
+                return
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        # Importing aiogram takes seconds, so modules that only queue messages don't pay for it
+        from aiogram.exceptions import TelegramRetryAfter
+
+        while True:
+            _, _, chat_id = await self._ready.get()
+            chat = self._chats[chat_id]
+            message = chat.messages.popleft()
+            await self._acquire_global()
+            chat.bucket.consume()
+            started = time.monotonic()
+            try:
+                result = await self.bot.send_message(chat_id, message.text, **message.kwargs)
+            except TelegramRetryAfter as e:
+                self._stats['retry_after'] += 1
+                message.attempts += 1
+                if message.attempts < OUTBOUND_MAX_RETRIES:
+                    # Flood control applies to the whole bot, so every worker pauses
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    chat.messages.appendleft(message)
+                    self._schedule(chat_id, chat, e.retry_after)
+                    continue
+                self._complete(message, started, error=e)
+            except Exception as e:
+                self._complete(message, started, error=e)
+            else:
+                self._complete(message, started, result=result)
+            self._finish(chat_id, chat)
+
+    def _complete(self, message, started, result=None, error=None):
+        stats = self._stats
+        now = time.monotonic()
+        stats['queued'] -= 1
+        stats['send_time_total'] += now - started
+        stats['send_time_max'] = max(stats['send_time_max'], now - started)
+        stats['queue_wait_total'] += started - message.enqueued_at
+        stats['queue_wait_max'] = max(stats['queue_wait_max'], started - message.enqueued_at)
+        priority = 'bulk' if message.priority == PRIORITY_BULK else 'transactional'
+        outbound_send_seconds.observe(now - started, priority, 'error' if error is not None else 'ok')
+        outbound_queue_wait_seconds.observe(started - message.enqueued_at, priority)
+        if message.future.done():
+            return
+        if error is not None:
+            stats['failed'] += 1
+            message.future.set_exception(error)
+        else:
+            stats['sent'] += 1
+            message.future.set_result(result)
+
+    def stats(self):
+        stats = self._stats
+        completed = stats['sent'] + stats['failed']
+        return {
+            'queue_depth': stats['queued'],
+            'active_chats': len(self._chats),
+            'sent': stats['sent'],
+            'failed': stats['failed'],
+            'retry_after_429': stats['retry_after'],
+            'send_latency_avg_ms': round(stats['send_time_total'] / completed * 1000, 3) if completed else 0.0,
+            'send_latency_max_ms': round(stats['send_time_max'] * 1000, 3),
+            'queue_wait_avg_ms': round(stats['queue_wait_total'] / completed * 1000, 3) if completed else 0.0,
+            'queue_wait_max_ms': round(stats['queue_wait_max'] * 1000, 3),
+        }
+
+
+dispatcher = OutboundDispatcher()
+
+
+async def _collect_metrics():
+    stats = dispatcher.stats()
+    for stat in ('queue_depth', 'active_chats', 'sent', 'failed', 'retry_after_429'):
+        outbound_gauge.set(stats[stat], stat)
+
+
+add_collector(_collect_metrics)
+
+
+def send_message(chat_id, text, bulk=False, **kwargs):
+    """Queue a Telegram message through the shared dispatcher."""
+    return dispatcher.send(chat_id, text, priority=PRIORITY_BULK if bulk else PRIORITY_TRANSACTIONAL, **kwargs)
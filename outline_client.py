@@ -0,0 +1,130 @@
+# outline_client.py
+import asyncio
+import logging
+import re
+import time
+
+import aiohttp
+
+from metrics import Counter, Histogram
+
+
+class OutlineError(Exception):
+    pass
+
+
+NOT_FOUND = object()
+
+outline_request_seconds = Histogram('hrvpn_outline_request_seconds', "Outline management API call latency",
+                                    ('server', 'method', 'endpoint'))
+outline_errors_total = Counter('hrvpn_outline_errors_total', "Failed Outline management API calls",
+                               ('server', 'method', 'endpoint'))
+
+
+class OutlineClient:
+    """Asynchronous client for the Outline server management API.
+
+    All calls share one aiohttp session with keep-alive connections. The server's
+    self-signed certificate is pinned by its SHA-256 fingerprint.
+    """
+
+    def __init__(self, api_url, cert_sha256=None, timeout=10, pool_size=20, name='default'):
+        self.api_url = (api_url or '').rstrip('/')
+        self.name = name  # Server label in metrics
+        self.cert_sha256 = cert_sha256
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self._session = None
+        self._loop = None
+        self._created_at = {}  # key_id -> monotonic time of creation through this client
+
+    def _ssl(self):
+        if not self.cert_sha256 or not self.api_url.startswith('https'):
+            return None
+        fingerprint = self.cert_sha256.split('=')[-1].replace(':', '').strip()
+        return aiohttp.Fingerprint(bytes.fromhex(fingerprint))
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60, ssl=self._ssl())
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, method, path, *, json=None, data=None, timeout=None, allow_not_found=False):
+        session = self._get_session()
+        options = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        endpoint = re.sub(r'/access-keys/[^/]+', '/access-keys/{id}', path)
+        started = time.perf_counter()
+        try:
+            async with session.request(method, f"{self.api_url}{path}", json=json, data=data,
+                                       **options) as response:
+                if response.status == 404 and allow_not_found:
+                    return NOT_FOUND
+                if response.status >= 400:
+                    body = await response.text()
+                    raise OutlineError(f"{method} {path} failed with {response.status}: {body[:200]}")
+                if response.status == 204:
+                    return None
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            outline_errors_total.inc(self.name, method, endpoint)
+            raise OutlineError(f"{method} {path} failed: {e!r}") from e
+        except OutlineError:
+            outline_errors_total.inc(self.name, method, endpoint)
+            raise
+        finally:
+            outline_request_seconds.observe(time.perf_counter() - started, self.name, method, endpoint)
+
+    async def create_key(self, name=None, timeout=None):
+        payload = {'name': name} if name else None
+        key = await self._request('POST', '/access-keys', json=payload, timeout=timeout)
+        self._created_at[key['id']] = time.monotonic()
+        # Older servers ignore the name in the create request
+        if name and key.get('name') != name:
+            await self.rename_key(key['id'], name, timeout=timeout)
+            key['name'] = name
+        return key
+
+    def recently_created(self, max_age):
+        """Ids of keys this client created within the last max_age seconds."""
+        threshold = time.monotonic() - max_age
+        for key_id in [key_id for key_id, created_at in self._created_at.items() if created_at < threshold]:
+            del self._created_at[key_id]
+        return set(self._created_at)
+
+    async def rename_key(self, key_id, name, timeout=None):
+        await self._request('PUT', f'/access-keys/{key_id}/name', data={'name': name}, timeout=timeout)
+
+    async def get_key(self, key_id, timeout=None):
+        key = await self._request('GET', f'/access-keys/{key_id}', timeout=timeout, allow_not_found=True)
+        return None if key is NOT_FOUND else key
+
+    async def get_keys(self, timeout=None):
+        result = await self._request('GET', '/access-keys', timeout=timeout)
+        return result.get('accessKeys', [])
+
+    async def delete_key(self, key_id, timeout=None):
+        """Delete a key; returns False if the server did not have it."""
+        result = await self._request('DELETE', f'/access-keys/{key_id}', timeout=timeout, allow_not_found=True)
+        if result is NOT_FOUND:
+            logging.warning("Key %s was already missing on the Outline server", key_id)
+            return False
+        return True
+
+    async def set_data_limit(self, key_id, limit_bytes, timeout=None):
+        await self._request('PUT', f'/access-keys/{key_id}/data-limit',
+                            json={'limit': {'bytes': limit_bytes}}, timeout=timeout)
+
+    async def get_transfer_metrics(self, timeout=None):
+        result = await self._request('GET', '/metrics/transfer', timeout=timeout)
+        return result.get('bytesTransferredByUserId', {})
+
+    async def get_server_info(self, timeout=None):
+        return await self._request('GET', '/server', timeout=timeout)
@@ -0,0 +1,365 @@
+# outline_emulator.py
+"""In-memory emulator of the Outline server management API.
+
+Covers access-key create/rename/list/get/delete, per-key and server-wide data limits,
+transfer metrics and server info. Each endpoint can be given a latency distribution,
+an error rate and a rate limit, so slow or flaky servers can be reproduced offline.
+
+    python outline_emulator.py --port 8081 --seed-keys 5000 \\
+        --latency '*=lognormal:0.05,0.6' --latency 'POST /access-keys=fixed:0.4' \\
+        --error-rate 'DELETE /access-keys/{id}=0.05' --rate-limit '*=100'
+
+Endpoint names are "METHOD /route/template" as listed in ROUTES; "*" applies to all.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from aiohttp import web
+
+ROUTES = (
+    ('GET', '/server'),
+    ('GET', '/access-keys'),
+    ('POST', '/access-keys'),
+    ('GET', '/access-keys/{id}'),
+    ('PUT', '/access-keys/{id}'),
+    ('DELETE', '/access-keys/{id}'),
+    ('PUT', '/access-keys/{id}/name'),
+    ('PUT', '/access-keys/{id}/data-limit'),
+    ('DELETE', '/access-keys/{id}/data-limit'),
+    ('PUT', '/server/access-key-data-limit'),
+    ('DELETE', '/server/access-key-data-limit'),
+    ('GET', '/metrics/transfer'),
+)
+ANY_ENDPOINT = '*'
+KEY_TRAFFIC_RATE = 50_000  # Average bytes per second a key transfers
+
+
+def parse_latency(spec, rng=random):
+    """Turn "fixed:0.1", "uniform:0.01,0.2", "normal:0.1,0.02", "lognormal:median,sigma"
+    or "exponential:mean" into a function returning a delay in seconds."""
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == 'exponential':
+        return lambda: rng.expovariate(1 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class _RateLimit:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class OutlineEmulator:
+    """Outline management API kept in memory.
+
+    latency maps endpoint -> distribution spec (see parse_latency), error_rates maps
+    endpoint -> probability of answering error_status, rate_limits maps endpoint ->
+    requests per second above which it answers 429. The "*" entry is the default for
+    endpoints without their own. start() serves from a background thread, serve() from
+    the current loop.
+    """
+
+    def __init__(self, latency=None, error_rates=None, rate_limits=None, error_status=500,
+                 seed_keys=0, host='127.0.0.1', port=0, random_seed=None):
+        self.random = random.Random(random_seed)
+        self.latency = {endpoint: parse_latency(spec, self.random) for endpoint, spec in (latency or {}).items()}
+        self.error_rates = dict(error_rates or {})
+        self.rate_limits = {endpoint: _RateLimit(rate) for endpoint, rate in (rate_limits or {}).items()}
+        self.error_status = error_status
+        self.host = host
+        self.port = port
+        self.keys = {}
+        self.data_limit = None
+        self.stats = {}
+        self._next_id = 1
+        self._started_at = time.time()
+        self._traffic = {}  # key_id -> (creation time, bytes per second)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+        self.reset(seed_keys)
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def _setting(self, table, endpoint):
+        return table.get(endpoint, table.get(ANY_ENDPOINT))
+
+    def _record(self, endpoint, outcome):
+        counts = self.stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'rate_limited': 0})
+        counts['requests'] += 1
+        if outcome:
+            counts[outcome] += 1
+
+    def _new_key(self, key_id=None, name=''):
+        if key_id is None:
+            key_id = str(self._next_id)
+        if key_id.isdigit():
+            self._next_id = max(self._next_id, int(key_id) + 1)
+        password = f"emu{key_id}"
+        credentials = base64.urlsafe_b64encode(f"chacha20-ietf-poly1305:{password}".encode()).decode().rstrip('=')
+        key = {
+            'id': key_id,
+            'name': name,
+            'password': password,
+            'port': 12345,
+            'method': 'chacha20-ietf-poly1305',
+            'accessUrl': f"ss://{credentials}@{self.host}:12345/?outline=1",
+        }
+        self.keys[key_id] = key
+        self._traffic[key_id] = (time.time(), self.random.expovariate(1 / KEY_TRAFFIC_RATE))
+        return key
+
+    def _reset(self, seed_keys):
+        self.keys = {}
+        self._traffic = {}
+        self._next_id = 1
+        self.data_limit = None
+        self.stats = {}
+        self._started_at = time.time()
+        for _ in range(seed_keys):
+            self._new_key(name=f"Seeded_{self._next_id}")
+
+    def reset(self, seed_keys=0):
+        """Drop all state and create seed_keys keys with ids 1..seed_keys."""
+        if self._loop is None or not self._loop.is_running():
+            self._reset(seed_keys)
+            return
+        asyncio.run_coroutine_threadsafe(self._call(self._reset, seed_keys), self._loop).result()
+
+    @staticmethod
+    async def _call(func, *args):
+        return func(*args)
+
+    def transfer_metrics(self):
+        now = time.time()
+        return {key_id: int(rate * (now - created)) for key_id, (created, rate) in self._traffic.items()}
+
+    @web.middleware
+    async def _faults(self, request, handler):
+        resource = request.match_info.route.resource
+        endpoint = f"{request.method} {resource.canonical if resource is not None else request.path}"
+        limit = self._setting(self.rate_limits, endpoint)
+        if limit is not None and not limit.allow():
+            self._record(endpoint, 'rate_limited')
+            return web.json_response({'code': 'TooManyRequests'}, status=429)
+        latency = self._setting(self.latency, endpoint)
+        if latency is not None:
+            await asyncio.sleep(latency())
+        error_rate = self._setting(self.error_rates, endpoint)
+        if error_rate and self.random.random() < error_rate:
+            self._record(endpoint, 'errors')
+            return web.json_response({'code': 'InternalError', 'message': 'injected fault'},
+                                     status=self.error_status)
+        self._record(endpoint, None)
+        return await handler(request)
+
+    async def _body(self, request):
+        if not request.can_read_body:
+            return {}
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    def _key(self, request):
+        key = self.keys.get(request.match_info['id'])
+        if key is None:
+            raise web.HTTPNotFound(text=json.dumps({'code': 'NotFound', 'message': 'Access key not found'}),
+                                   content_type='application/json')
+        return key
+
+    def _limit_bytes(self, body):
+        try:
+            limit = int(body['limit']['bytes'])
+        except (KeyError, TypeError, ValueError):
+            raise web.HTTPBadRequest(text='Missing or invalid limit.bytes')
+        if limit < 0:
+            raise web.HTTPBadRequest(text='limit.bytes must be non-negative')
+        return limit
+
+    async def _server(self, request):
+        info = {'name': 'Outline emulator', 'serverId': 'emulator', 'metricsEnabled': True,
+                'createdTimestampMs': int(self._started_at * 1000), 'portForNewAccessKeys': 12345}
+        if self.data_limit is not None:
+            info['accessKeyDataLimit'] = {'bytes': self.data_limit}
+        return web.json_response(info)
+
+    async def _list_keys(self, request):
+        return web.json_response({'accessKeys': list(self.keys.values())})
+
+    async def _create_key(self, request):
+        body = await self._body(request)
+        key = self._new_key(name=body.get('name', ''))
+        if 'limit' in body:
+            key['dataLimit'] = {'bytes': self._limit_bytes(body)}
+        return web.json_response(key, status=201)
+
+    async def _get_key(self, request):
+        return web.json_response(self._key(request))
+
+    async def _put_key(self, request):
+        key_id = request.match_info['id']
+        if key_id in self.keys:
+            raise web.HTTPConflict(text='Access key already exists')
+        body = await self._body(request)
+        return web.json_response(self._new_key(key_id, name=body.get('name', '')), status=201)
+
+    async def _delete_key(self, request):
+        key = self._key(request)
+        del self.keys[key['id']]
+        del self._traffic[key['id']]
+        return web.Response(status=204)
+
+    async def _rename_key(self, request):
+        key = self._key(request)
+        key['name'] = (await self._body(request)).get('name', '')
+        return web.Response(status=204)
+
+    async def _set_key_limit(self, request):
+        key = self._key(request)
+        key['dataLimit'] = {'bytes': self._limit_bytes(await self._body(request))}
+        return web.Response(status=204)
+
+    async def _remove_key_limit(self, request):
+        self._key(request).pop('dataLimit', None)
+        return web.Response(status=204)
+
+    async def _set_server_limit(self, request):
+        self.data_limit = self._limit_bytes(await self._body(request))
+        return web.Response(status=204)
+
+    async def _remove_server_limit(self, request):
+        self.data_limit = None
+        return web.Response(status=204)
+
+    async def _transfer(self, request):
+        return web.json_response({'bytesTransferredByUserId': self.transfer_metrics()})
+
+    async def _emulator_stats(self, request):
+        return web.json_response({'keys': len(self.keys), 'endpoints': self.stats})
+
+    def app(self):
+        handlers = {
+            ('GET', '/server'): self._server,
+            ('GET', '/access-keys'): self._list_keys,
+            ('POST', '/access-keys'): self._create_key,
+            ('GET', '/access-keys/{id}'): self._get_key,
+            ('PUT', '/access-keys/{id}'): self._put_key,
+            ('DELETE', '/access-keys/{id}'): self._delete_key,
+            ('PUT', '/access-keys/{id}/name'): self._rename_key,
+            ('PUT', '/access-keys/{id}/data-limit'): self._set_key_limit,
+            ('DELETE', '/access-keys/{id}/data-limit'): self._remove_key_limit,
+            ('PUT', '/server/access-key-data-limit'): self._set_server_limit,
+            ('DELETE', '/server/access-key-data-limit'): self._remove_server_limit,
+            ('GET', '/metrics/transfer'): self._transfer,
+        }
+        app = web.Application(middlewares=[self._faults])
+        for method, path in ROUTES:
+            app.router.add_route(method, path, handlers[method, path])
+        # Not part of the Outline API: counters of served, failed and throttled requests
+        app.router.add_get('/_emulator/stats', self._emulator_stats)
+        return app
+
+    async def serve(self):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self._runner
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self.serve())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self):
+        """Serve from a background thread with its own loop, so its work stays out of the caller's loop."""
+        self._thread = threading.Thread(target=self._run, name='outline-emulator', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+
+def _endpoint_options(values, convert):
+    options = {}
+    for value in values or ():
+        endpoint, _, setting = value.rpartition('=')
+        options[endpoint or ANY_ENDPOINT] = convert(setting)
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outline management API emulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--seed-keys', type=int, default=0, help="keys created at startup")
+    parser.add_argument('--latency', action='append', help="[ENDPOINT=]DISTRIBUTION, e.g. '*=fixed:0.05'")
+    parser.add_argument('--error-rate', action='append', help="[ENDPOINT=]PROBABILITY")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--rate-limit', action='append', help="[ENDPOINT=]REQUESTS_PER_SECOND")
+    parser.add_argument('--random-seed', type=int)
+    args = parser.parse_args()
+
+    emulator = OutlineEmulator(
+        latency=_endpoint_options(args.latency, str),
+        error_rates=_endpoint_options(args.error_rate, float),
+        rate_limits=_endpoint_options(args.rate_limit, float),
+        error_status=args.error_status,
+        seed_keys=args.seed_keys,
+        host=args.host,
+        port=args.port,
+        random_seed=args.random_seed,
+    )
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        await emulator.serve()
+        logging.info("Outline emulator with %s keys listening on %s", len(emulator.keys), emulator.url)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
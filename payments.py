@@ -0,0 +1,190 @@
+# payments.py
+import asyncio
+import decimal
+import logging
+import os
+import time
+
+from db import (
+    extend_subscription,
+    finish_payment,
+    get_due_payments,
+    get_next_payment_attempt,
+    is_operation_processed,
+    retry_payment
+)
+from key_pool import provision_key
+from outbound import send_message
+
+PAYMENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_MAX_ATTEMPTS', '10'))  # Attempts before a payment is marked failed
+PAYMENT_RETRY_BASE = 5  # Seconds before the first retry, doubled after every failure
+PAYMENT_RETRY_MAX = 1800  # Longest pause between retries
+PAYMENT_POLL_INTERVAL = 30  # Seconds between inbox checks when nothing wakes the worker
+
+# Сумма платежа -> срок подписки в днях
+AMOUNT_MAPPING = {
+    # decimal.Decimal('5.00'): 5,
+    decimal.Decimal('200.00'): 30,
+    decimal.Decimal('500.00'): 90,
+    decimal.Decimal('1000.00'): 180
+}
+
+_payment_received = asyncio.Event()
+
+
+class PaymentRejected(Exception):
+    """The notification can never be processed, retrying would not help.
+
+    user_message, if given, is sent to the payer once the rejection is recorded.
+    """
+
+    def __init__(self, reason, user_message=None):
+        super().__init__(reason)
+        self.user_message = user_message
+
+
+def notify_payment_received():
+    _payment_received.set()
+
+
+def _match_amount(withdraw_amount_str):
+    # Преобразуем withdraw_amount_str в Decimal
+    try:
+        paid_amount = decimal.Decimal(withdraw_amount_str.replace(',', '.').strip())
+        paid_amount = paid_amount.quantize(decimal.Decimal('1.00'))  # Округляем до 2 знаков
+    except decimal.InvalidOperation:
+        raise PaymentRejected(f"Некорректная сумма withdraw_amount: {withdraw_amount_str}")
+
+    for amount in AMOUNT_MAPPING:
+        if abs(paid_amount - amount) <= decimal.Decimal('0.01'):
+            return amount
+    return None
+
+
+def _user_id_from_label(label):
+    parts = label.split('_')
+    if label.startswith('renew_') and len(parts) < 2:
+        return None
+    user_id_str = parts[1] if label.startswith('renew_') else parts[0]
+    return int(user_id_str) if user_id_str.isdigit() else None
+
+
+async def process_payment(operation_id, data):
+    """Apply one verified YooMoney notification. Safe to call again for the same operation_id."""
+    if await is_operation_processed(operation_id):
+        logging.info("Уведомление с operation_id %s уже обработано.", operation_id,
+                     extra={'operation_id': operation_id})
+        return
+
+    label = data.get('label', '')
+    if not label:
+        raise PaymentRejected("Отсутствует label в уведомлении")
+
+    matching_amount = _match_amount(data.get('withdraw_amount', ''))
+    if not matching_amount:
+        raise PaymentRejected(f"Не удалось найти соответствие для суммы {data.get('withdraw_amount')}",
+                              user_message="Получена неверная сумма оплаты.")
+
+    expected_period = AMOUNT_MAPPING[matching_amount]
+    payment = {
+        'operation_id': operation_id,
+        'amount': float(matching_amount),
+        'period': expected_period,
+        'label': label,
+    }
+
+    if label.startswith('renew_'):
+        # Обработка продления подписки
+        parts = label.split('_')
+        if len(parts) < 4:
+            raise PaymentRejected(f"Некорректный формат label для продления: {label}")
+
+        _, user_id_str, sub_id_str, _ = parts
+        if not user_id_str.isdigit() or not sub_id_str.isdigit():
+            raise PaymentRejected(f"Некорректные идентификаторы в label: {label}")
+
+        user_id = int(user_id_str)
+        sub_id = int(sub_id_str)
+
+        # Продление и история покупки сохраняются в одной транзакции. Сообщения после нее только
+        # ставятся в очередь: платеж уже учтен, ошибка отправки не должна вызывать повтор
+        if await extend_subscription(user_id, sub_id, expected_period, {**payment, 'action': 'renew_subscription'}):
+            send_message(user_id, f"Оплата получена! Ваша подписка продлена на {expected_period} дней.")
+        else:
+            send_message(user_id, "Оплата получена, но подписка для продления не найдена. "
+                                   "Пожалуйста, свяжитесь с поддержкой.")
+    else:
+        # Обработка новых подписок
+        parts = label.split('_')
+        if len(parts) < 2 or not parts[0].isdigit():
+            raise PaymentRejected(f"Некорректный формат label для новой подписки: {label}")
+
+        user_id = int(parts[0])
+
+        # Выдаём VPN-ключ из пула; подписка и история покупки сохраняются в одной транзакции
+        vpn_key_data = await provision_key(user_id, expected_period,
+                                           payment={**payment, 'action': 'new_subscription'})
+        if not vpn_key_data:
+            # Повторим позже: сервер Outline мог быть временно недоступен
+            raise RuntimeError(f"Ошибка при создании VPN-ключа для пользователя {user_id}")
+        # Создаем клавиатуру с кнопкой "Инструкция"
+        from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="Инструкция", callback_data="instruction")]
+            ]
+        )
+        # Отправляем сообщение с ключом и клавиатурой; очередь чата сохраняет их порядок
+        send_message(user_id, "Оплата получена! Ваш ключ:")
+        send_message(user_id, f"{vpn_key_data['accessUrl']}", reply_markup=keyboard)
+
+
+async def _process_inbox_entry(operation_id, data, attempts):
+    started = time.monotonic()
+    try:
+        await process_payment(operation_id, data)
+    except PaymentRejected as e:
+        logging.error("Платеж %s отклонен: %s", operation_id, e, extra={'operation_id': operation_id})
+        await finish_payment(operation_id, 'failed', str(e))
+        user_id = _user_id_from_label(data.get('label', ''))
+        if e.user_message and user_id is not None:
+            # Сообщение только ставится в очередь: ошибка отправки не должна менять судьбу платежа
+            send_message(user_id, e.user_message)
+    except Exception as e:
+        attempts += 1
+        if attempts >= PAYMENT_MAX_ATTEMPTS:
+            logging.error("Платеж %s не обработан после %s попыток: %s", operation_id, attempts, e,
+                          extra={'operation_id': operation_id})
+            await finish_payment(operation_id, 'failed', str(e))
+            user_id = _user_id_from_label(data.get('label', ''))
+            if user_id is not None:
+                send_message(user_id, "Ошибка при обработке оплаты. Пожалуйста, свяжитесь с поддержкой.")
+            return
+        delay = min(PAYMENT_RETRY_BASE * 2 ** (attempts - 1), PAYMENT_RETRY_MAX)
+        logging.warning("Ошибка при обработке платежа %s, попытка %s, повтор через %s с: %s",
+                        operation_id, attempts, delay, e, extra={'operation_id': operation_id})
+        await retry_payment(operation_id, attempts, int(time.time()) + delay, str(e))
+    else:
+        # Платеж уже был учтен раньше, если запись не обновилась в транзакции с подпиской
+        await finish_payment(operation_id, 'done')
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        logging.info("Платеж %s обработан за %s мс", operation_id, latency_ms,
+                     extra={'operation_id': operation_id, 'latency_ms': latency_ms})
+
+
+async def run_payment_worker():
+    while True:
+        _payment_received.clear()
+        timeout = PAYMENT_POLL_INTERVAL
+        try:
+            for operation_id, data, attempts in await get_due_payments(int(time.time())):
+                await _process_inbox_entry(operation_id, data, attempts)
+            next_attempt = await get_next_payment_attempt()
+            if next_attempt is not None:
+                timeout = min(max(next_attempt - time.time(), 0), PAYMENT_POLL_INTERVAL)
+        except Exception as e:
+            logging.error("Ошибка при обработке входящих платежей: %s", e)
+        try:
+            await asyncio.wait_for(_payment_received.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,101 @@
+# scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from db import EXPIRY_WINDOWS, get_upcoming_expiries
+
+# The longest offset before expiry at which something has to happen (the 5-day warning)
+MAX_LEAD_SECONDS = max(upper for _, upper, _ in EXPIRY_WINDOWS.values())
+
+
+class DeadlineScheduler:
+    """Sleeps until the next subscription deadline and then runs the expiry handler.
+
+    Deadlines (5-day warning, 1-day warning, revocation) live in a min-heap. Only
+    subscriptions whose deadlines fall within the next `horizon` seconds are kept in
+    memory; the heap is rebuilt from the database once per horizon, which also acts as
+    a periodic safety sweep for changes made by other processes.
+    """
+
+    def __init__(self, handler, horizon=3600):
+        self.handler = handler
+        self.horizon = horizon
+        self._heap = []  # (deadline_ts, seq, sub_id, expires_at_ts)
+        self._expiry = {}  # sub_id -> expires_at_ts of the live heap entries
+        self._seq = itertools.count()
+        self._horizon_end = 0
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, sub_id, expires_at_ts):
+        """Track a new or changed expiry; None forgets the subscription."""
+        if expires_at_ts is None:
+            self._expiry.pop(sub_id, None)
+            return
+        self._expiry[sub_id] = expires_at_ts
+        now = time.time()
+        for lower, upper, _ in EXPIRY_WINDOWS.values():
+            window_start = expires_at_ts - upper
+            window_end = math.inf if lower is None else expires_at_ts - lower
+            if window_end <= now:
+                continue
+            deadline = max(window_start, math.ceil(now))
+            if deadline > self._horizon_end:
+                continue  # Picked up by the next reload
+            heapq.heappush(self._heap, (deadline, next(self._seq), sub_id, expires_at_ts))
+            if self._heap[0][0] == deadline:
+                self._wakeup.set()
+
+    def stats(self):
+        return {
+            'pending_deadlines': len(self._heap),
+            'tracked_subscriptions': len(self._expiry),
+            'next_deadline': self._heap[0][0] if self._heap else None,
+        }
+
+    async def _run_handler(self):
+        try:
+            await self.handler()
+        except Exception as e:
+            logging.error("Ошибка при обработке истекающих подписок: %s", e)
+
+    async def _reload(self):
+        # Catch up on everything that is already due, then load the next horizon
+        await self._run_handler()
+        now = int(time.time())
+        self._heap = []
+        self._expiry = {}
+        self._horizon_end = now + self.horizon
+        rows = await get_upcoming_expiries(now, self._horizon_end + MAX_LEAD_SECONDS)
+        for sub_id, expires_at_ts in rows:
+            self.schedule(sub_id, expires_at_ts)
+        logging.info("Загружено %s сроков подписок до %s", len(self._heap), self._horizon_end)
+
+    async def run(self):
+        # A scheduler restarted after losing leadership may have missed changes, so it reloads first
+        self._horizon_end = 0
+        while True:
+            now = time.time()
+            if now >= self._horizon_end:
+                await self._reload()
+                continue
+
+            due = False
+            while self._heap and self._heap[0][0] <= now:
+                _, _, sub_id, expires_at_ts = heapq.heappop(self._heap)
+                # Entries left behind by an extension or deletion are skipped
+                if self._expiry.get(sub_id) == expires_at_ts:
+                    due = True
+            if due:
+                await self._run_handler()
+                continue
+
+            next_wakeup = min(self._heap[0][0], self._horizon_end) if self._heap else self._horizon_end
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_wakeup - now))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,34 @@
+# settings.py
+"""Credentials and endpoints shared by the bot, the admin app and the tools.
+
+.env is read once, here; entry points import this module before anything else so that
+the module-level settings of every other module see it too. Settings used by a single
+module stay next to the code that reads them.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Telegram
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_BOT_TOKEN_LOGGER = os.getenv('TELEGRAM_BOT_TOKEN_LOGGER')  # Bot that forwards the log (logs_bot.py)
+CHAT_ID = os.getenv('CHAT_ID')  # User that receives the forwarded log
+
+# Outline
+OUTLINE_API = os.getenv('OUTLINE_API')
+CERT_SHA256 = os.getenv('CERT_SHA256')
+# JSON list of {"name", "api_url", "cert_sha256", "weight"}; defaults to the single OUTLINE_API server.
+# Subscriptions created before the fleet existed belong to the server named "default".
+OUTLINE_SERVERS = os.getenv('OUTLINE_SERVERS')
+
+# YooMoney
+YOOMONEY_SECRET = os.getenv('YOOMONEY_SECRET')
+YOOMONEY_WALLET = os.getenv('YOOMONEY_WALLET')
+NOTIFICATION_URL = os.getenv('NOTIFICATION_URL')
+
+# Admin app
+SECRET_KEY = os.getenv('SECRET_KEY') or ''
+USER_NAME = os.getenv('USER_NAME')
+USER_PASSWORD = os.getenv('USER_PASSWORD')
@@ -0,0 +1,83 @@
+# startup.py
+"""Startup profiling.
+
+StartupProfile times the startup phases of a process; main.py logs the report once it
+serves requests. Run as a script to measure the cold import of entry modules, each in a
+fresh interpreter:
+
+    python startup.py main admin_app cluster logs_bot
+"""
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Measured in the child: import time and peak memory, printed on one line
+_PROBE = ("import resource, time; started = time.perf_counter(); import {module}; "
+          "print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = []
+
+    def mark(self, phase):
+        """Record the phase that has just finished."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        total = self._last - self.started
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logging.info("Запуск занял %.2f с (%s), пик памяти %.0f МБ", total,
+                     ', '.join(f"{phase} {seconds:.2f} с" for phase, seconds in self.phases), peak_mb,
+                     extra={'latency_ms': round(total * 1000)})
+
+
+startup_profile = StartupProfile()
+
+
+def profile_import(module, top=5):
+    """Import module in a fresh interpreter; returns seconds, peak RSS in MB and the heaviest packages."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module)],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    seconds, peak_kb = result.stdout.split()[-2:]
+    # Lines look like "import time:  self_us | cumulative_us | <indent>package.module"
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return float(seconds), int(peak_kb) / 1024, [(package, us / 1e6) for package, us in heaviest]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold import of entry modules")
+    parser.add_argument('modules', nargs='*', default=['main', 'admin_app', 'cluster', 'logs_bot'])
+    parser.add_argument('--top', type=int, default=5, help="packages listed per module")
+    args = parser.parse_args()
+    print(f"{'module':<14} {'import, s':>10} {'peak, MB':>9}  heaviest packages")
+    for module in args.modules:
+        try:
+            seconds, peak_mb, heaviest = profile_import(module, args.top)
+        except RuntimeError as e:
+            print(f"{module:<14} failed: {e}")
+            continue
+        packages = ', '.join(f"{package} {package_seconds:.2f}" for package, package_seconds in heaviest)
+        print(f"{module:<14} {seconds:>10.2f} {peak_mb:>9.0f}  {packages}")
+
+
+if __name__ == '__main__':
+    main()
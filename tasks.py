@@ -1,130 +1,209 @@
 # tasks.py
-import aiosqlite
 import asyncio
 import logging
-from datetime import datetime, timezone, timedelta
-from db import get_all_subscriptions, delete_subscription, update_subscription_async
-from vpn_manager import manager
-from telegram_bot import bot
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-
-DB_FILE = 'subscriptions.db'
+import os
+import time
+from datetime import datetime, timezone
+from db import (
+    add_subscription_listener,
+    remove_subscription_listener,
+    delete_subscriptions,
+    get_subscriptions_due,
+    mark_subscriptions_notified,
+    get_all_key_ids,
+    delete_subscriptions_by_key_ids
+)
+from scheduler import DeadlineScheduler
+from vpn_manager import get_manager
+from outbound import send_message
+
+EXPIRY_CONCURRENCY = int(os.getenv('EXPIRY_CONCURRENCY', '16'))  # Parallel key deletions per Outline server
+EXPIRY_RETRIES = 3  # Attempts to delete one expired key before it waits for the next pass
+EXPIRY_RETRY_DELAY = 1  # Seconds before the first retry, doubled after each attempt
+SYNC_INTERVAL = 600  # Seconds between key reconciliation runs
+SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY', '8'))  # Parallel delete calls to the Outline server
+SYNC_GRACE_SECONDS = int(os.getenv('SYNC_GRACE_SECONDS', '300'))  # Keys created this recently are never deleted
+SYNC_DRY_RUN = os.getenv('SYNC_DRY_RUN', '').lower() in ('1', 'true', 'yes')  # Only report the difference
+
+last_sync_stats = {}
+
+
+def _keyboard(text, callback_data):
+    from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=text, callback_data=callback_data)]]
+    )
+
+
+async def _send_expiry_warnings(window, column, text, now_ts):
+    due = await get_subscriptions_due(window, now_ts)
+    if not due:
+        return
+    # Флаги ставятся одной транзакцией до отправки; сообщения уходят через очередь outbound,
+    # которая сама повторяет отправку после 429, поэтому здесь их не ждем
+    await mark_subscriptions_notified([sub_id for sub_id, _, _, _ in due], column)
+    keyboard = _keyboard("Продлить подписку", "renew_subscription")
+    for sub_id, user_id, key_id, server in due:
+        send_message(user_id, text, bulk=True, reply_markup=keyboard)
+    logging.info("Поставлено в очередь уведомлений об окончании подписки (%s): %s", window, len(due))
+
+
+async def process_due_subscriptions():
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+
+    await _send_expiry_warnings('5_days', 'notified_5_days', "До окончания вашей подписки осталось 5 дней.", now_ts)
+    await _send_expiry_warnings('1_day', 'notified_1_day', "До окончания вашей подписки остался 1 день.", now_ts)
+
+    # Истекшие подписки: ключи удаляются параллельно на всех серверах, затем подписки
+    # удаляются из базы одной транзакцией и пользователям ставятся сообщения в очередь
+    expired_by_server = {}
+    for sub_id, user_id, key_id, server in await get_subscriptions_due('expired', now_ts):
+        expired_by_server.setdefault(server, []).append((sub_id, user_id, key_id))
+    if not expired_by_server:
+        return
+    started = time.monotonic()
+    revoked = await asyncio.gather(*(_revoke_expired(server, subscriptions)
+                                     for server, subscriptions in expired_by_server.items()))
+    sub_ids = [sub_id for server_revoked in revoked for sub_id in server_revoked]
+    deleted = await delete_subscriptions(sub_ids) if sub_ids else []
+    keyboard = _keyboard("Оформить подписку", "buy_new_key")
+    for sub_id, user_id in deleted:
+        send_message(user_id,
+                     "Ваша подписка истекла. Ключ был удален. Оформите подписку, чтобы получить новый ключ.",
+                     bulk=True, reply_markup=keyboard)
+    total = sum(len(subscriptions) for subscriptions in expired_by_server.values())
+    logging.info("Обработано истекших подписок: %s из %s за %.1f с", len(deleted), total,
+                 time.monotonic() - started)
+
+
+async def _revoke_expired(server, subscriptions):
+    """Delete the keys of expired subscriptions on one server; returns the ids whose keys are gone."""
+    semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+    results = await asyncio.gather(*(_revoke_key(server, sub_id, user_id, key_id, semaphore)
+                                     for sub_id, user_id, key_id in subscriptions))
+    return [sub_id for (sub_id, _, _), revoked in zip(subscriptions, results) if revoked]
+
+
+async def _revoke_key(server, sub_id, user_id, key_id, semaphore):
+    extra = {'user_id': user_id, 'sub_id': sub_id, 'key_id': key_id, 'server': server}
+    for attempt in range(EXPIRY_RETRIES):
+        try:
+            async with semaphore:
+                await get_manager().delete_key(server, key_id)
+            logging.info("Ключ %s удален с сервера %s", key_id, server, extra=extra)
+            return True
+        except Exception as e:
+            error = e
+        if attempt + 1 < EXPIRY_RETRIES:
+            await asyncio.sleep(EXPIRY_RETRY_DELAY * 2 ** attempt)
+    # Подписка остается в базе и будет обработана при следующем проходе
+    logging.error("Ошибка при удалении ключа %s пользователя %s: %s", key_id, user_id, error, extra=extra)
+    send_message(user_id, f"Произошла ошибка при удалении вашего ключа {key_id}. Пожалуйста, свяжитесь с поддержкой.")
+    return False
+
+
+expiry_scheduler = DeadlineScheduler(process_due_subscriptions)
 
 
 async def check_subscriptions():
-    while True:
-        async with aiosqlite.connect(DB_FILE) as db:
-            cursor = await db.execute('''
-                SELECT id, user_id, key_id, expires_at, notified_5_days, notified_1_day, notified_expired 
-                FROM subscriptions
-            ''')
-            subscriptions = await cursor.fetchall()
-            for sub in subscriptions:
-                sub_id, user_id, key_id, expires_at_str, notified_5_days, notified_1_day, notified_expired = sub
-                expires_at = datetime.fromisoformat(expires_at_str).replace(tzinfo=timezone.utc)
-                now = datetime.now(timezone.utc)
-                time_left = expires_at - now
-                total_seconds_left = time_left.total_seconds()
-
-                # Проверка на 5 дней
-                if 345600 < total_seconds_left <= 432000 and not notified_5_days:
-                    keyboard = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text="Продлить подписку", callback_data="renew_subscription")]
-                        ]
-                    )
-                    try:
-                        await bot.send_message(user_id, "До окончания вашей подписки осталось 5 дней.",
-                                               reply_markup=keyboard)
-                        await db.execute('''
-                            UPDATE subscriptions SET notified_5_days = 1 WHERE id = ?
-                        ''', (sub_id,))
-                        await db.commit()
-                        logging.info(f"Уведомление о 5 днях до окончания подписки отправлено пользователю {user_id}")
-                    except Exception as e:
-                        logging.error(f"Ошибка при отправке уведомления о 5 днях пользователю {user_id}: {e}")
-
-                # Проверка на 1 день
-                elif 0 < total_seconds_left <= 86400 and not notified_1_day:
-                    keyboard = InlineKeyboardMarkup(
-                        inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text="Продлить подписку", callback_data="renew_subscription")]
-                        ]
-                    )
-                    try:
-                        await bot.send_message(user_id, "До окончания вашей подписки остался 1 день.",
-                                               reply_markup=keyboard)
-                        await db.execute('''
-                            UPDATE subscriptions SET notified_1_day = 1 WHERE id = ?
-                        ''', (sub_id,))
-                        await db.commit()
-                        logging.info(f"Уведомление о 1 дне до окончания подписки отправлено пользователю {user_id}")
-                    except Exception as e:
-                        logging.error(f"Ошибка при отправке уведомления о 1 дне пользователю {user_id}: {e}")
-
-                # Проверка на истечение подписки
-                elif total_seconds_left <= 0 and not notified_expired:
-                    try:
-                        manager.delete_key(key_id)
-                        logging.info(f"Ключ {key_id} удален с сервера")
-                        await delete_subscription(sub_id, user_id)
-                        keyboard = InlineKeyboardMarkup(
-                            inline_keyboard=[
-                                [InlineKeyboardButton(
-                                    text="Оформить подписку", callback_data="buy_new_key")]
-                            ]
-                        )
-                        await bot.send_message(user_id,
-                                               "Ваша подписка истекла. Ключ был удален. Оформите подписку, чтобы получить новый ключ.",
-                                               reply_markup=keyboard)
-                        await db.execute('''
-                            UPDATE subscriptions SET notified_expired = 1 WHERE id = ?
-                        ''', (sub_id,))
-                        await db.commit()
-                        logging.info(f"Уведомление об истечении подписки отправлено пользователю {user_id}")
-                    except Exception as e:
-                        logging.error(
-                            f"Ошибка при удалении ключа {key_id} или отправке уведомления пользователю {user_id}: {e}")
-                        await bot.send_message(user_id,
-                                               f"Произошла ошибка при удалении вашего ключа {key_id}. Пожалуйста, свяжитесь с поддержкой.")
-
-        await asyncio.sleep(3600)  # Проверяем каждый час
+    # Планировщик спит до ближайшего срока и раз в час перечитывает базу
+    add_subscription_listener(expiry_scheduler.schedule)
+    try:
+        await expiry_scheduler.run()
+    finally:
+        # Задача отменяется, когда процесс перестает быть лидером
+        remove_subscription_listener(expiry_scheduler.schedule)
+
+
+async def _delete_server_key(client, key_id, semaphore):
+    async with semaphore:
+        try:
+            deleted = await client.delete_key(key_id)
+            if deleted:
+                logging.info("Ненужный ключ %s удален с сервера %s", key_id, client.api_url)
+            return deleted
+        except Exception as e:
+            logging.error("Ошибка при удалении ключа %s: %s", key_id, e)
+            return None
+
+
+def _named_recently(key, max_age):
+    # Имена ключей заканчиваются временем создания ("User_<id>_<iso>", "Pool_<iso>"), поэтому
+    # окно защищает и ключи, созданные другими процессами кластера
+    try:
+        created_at = datetime.fromisoformat(key.get('name', '').rsplit('_', 1)[-1])
+    except ValueError:
+        return False
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created_at).total_seconds() < max_age
+
+
+async def reconcile_keys(server, dry_run=SYNC_DRY_RUN):
+    started = time.monotonic()
+    client = get_manager().client(server)
+
+    # База читается раньше сервера: ключ, созданный между двумя чтениями, окажется
+    # только на сервере, где его защищает окно SYNC_GRACE_SECONDS, а не будет удален из базы
+    db_key_ids = await get_all_key_ids(server)
+    server_keys = await client.get_keys()
+    server_key_ids = set(key['id'] for key in server_keys)
+    recent_key_ids = client.recently_created(SYNC_GRACE_SECONDS) | {
+        key['id'] for key in server_keys if _named_recently(key, SYNC_GRACE_SECONDS)}
+
+    # Ключи, которые есть на сервере, но отсутствуют в базе данных
+    keys_only_on_server = server_key_ids - db_key_ids - recent_key_ids
+    # Ключи, которые есть в базе данных, но отсутствуют на сервере
+    keys_only_in_db = db_key_ids - server_key_ids - recent_key_ids
+
+    stats = {
+        'dry_run': dry_run,
+        'server_keys': len(server_key_ids),
+        'db_keys': len(db_key_ids),
+        'only_on_server': len(keys_only_on_server),
+        'only_in_db': len(keys_only_in_db),
+        'skipped_recent': len(recent_key_ids & (server_key_ids ^ db_key_ids)),
+        'deleted_on_server': 0,
+        'failed_on_server': 0,
+        'deleted_in_db': 0,
+    }
+    if dry_run:
+        logging.info("Синхронизация %s (dry run): только на сервере %s, только в базе %s",
+                     server, sorted(keys_only_on_server), sorted(keys_only_in_db), extra={'server': server})
+    else:
+        semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+        results = await asyncio.gather(*(_delete_server_key(client, key_id, semaphore)
+                                         for key_id in keys_only_on_server))
+        # False: the key was already gone, it is neither deleted nor failed
+        stats['deleted_on_server'] = sum(1 for result in results if result is True)
+        stats['failed_on_server'] = sum(1 for result in results if result is None)
 
+        # Удаляем записи из базы данных для ключей, которых нет на сервере
+        if keys_only_in_db:
+            stats['deleted_in_db'] = await delete_subscriptions_by_key_ids(server, keys_only_in_db)
 
-async def sync_keys():
-    while True:
-        # Получаем все ключи с сервера
-        server_keys = manager.get_keys()
-        server_key_ids = set(key.key_id for key in server_keys)
-
-        # Получаем все ключи из базы данных
-        async with aiosqlite.connect(DB_FILE) as db:
-            cursor = await db.execute('SELECT key_id FROM subscriptions')
-            rows = await cursor.fetchall()
-            db_key_ids = set(row[0] for row in rows)
-
-        # Ключи, которые есть на сервере, но отсутствуют в базе данных
-        keys_only_on_server = server_key_ids - db_key_ids
-
-        # Ключи, которые есть в базе данных, но отсутствуют на сервере
-        keys_only_in_db = db_key_ids - server_key_ids
-
-        # Удаляем ключи с сервера, которые не должны там быть
-        for key_id in keys_only_on_server:
-            try:
-                manager.delete_key(key_id)
-                logging.info(f"Ненужный ключ {key_id} удален с сервера")
-            except Exception as e:
-                logging.error(f"Ошибка при удалении ключа {key_id}: {e}")
+    stats['wall_time_ms'] = round((time.monotonic() - started) * 1000, 1)
+    last_sync_stats[server] = stats
+    logging.info("Синхронизация ключей %s завершена: %s", server, stats,
+                 extra={'server': server, 'latency_ms': stats['wall_time_ms']})
+    return stats
 
-        # Удаляем записи из базы данных для ключей, которых нет на сервере
-        async with aiosqlite.connect(DB_FILE) as db:
-            for key_id in keys_only_in_db:
-                await db.execute('DELETE FROM subscriptions WHERE key_id = ?', (key_id,))
-                logging.info(f"Запись для ключа {key_id} удалена из базы данных")
-            await db.commit()
 
-        await asyncio.sleep(600)  # Синхронизируем раз в 10 минут
+async def reconcile_fleet(dry_run=SYNC_DRY_RUN):
+    # Серверы синхронизируются параллельно, ошибка одного не мешает остальным
+    servers = get_manager().names
+    results = await asyncio.gather(*(reconcile_keys(server, dry_run) for server in servers), return_exceptions=True)
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception):
+            logging.error("Ошибка при синхронизации ключей %s: %s", server, result)
+    return last_sync_stats
+
 
+async def sync_keys():
+    while True:
+        try:
+            await reconcile_fleet()
+        except Exception as e:
+            logging.error("Ошибка при синхронизации ключей: %s", e)
+        await asyncio.sleep(SYNC_INTERVAL)  # Синхронизируем раз в 10 минут
@@ -1,52 +1,90 @@
 # telegram_bot.py
 import logging
-import os
-import decimal
 import hmac
 import hashlib
+import time
 from datetime import datetime, timezone
 from urllib.parse import urlencode
 from aiohttp import web
 
-import aiosqlite
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, Router, types
 from aiogram.filters import Command
 from aiogram import F
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from dotenv import load_dotenv
-load_dotenv()
+from fsm_storage import SQLiteStorage
+from settings import NOTIFICATION_URL, TELEGRAM_BOT_TOKEN, YOOMONEY_SECRET, YOOMONEY_WALLET
 
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-YOOMONEY_SECRET = os.getenv('YOOMONEY_SECRET')
-YOOMONEY_WALLET = os.getenv('YOOMONEY_WALLET')
-NOTIFICATION_URL = os.getenv('NOTIFICATION_URL')
-DB_FILE = 'subscriptions.db'
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Обработчики регистрируются на роутере; бот и диспетчер создаются при первом обращении,
+# поэтому импорт модуля не требует токена и ничего не подключает
+router = Router()
 
 from db import (
+    TrialAlreadyUsed,
     add_user,
     get_subscriptions,
-    save_subscription,
-    extend_subscription,
-    save_purchase_history
+    get_traffic_usage,
+    has_used_test,
+    save_payment_notification
 )
-from vpn_manager import create_vpn_key_with_name, manager
+from key_pool import provision_key
+from loop_monitor import activity
+from metrics import Histogram
+from outbound import send_message
+from payments import notify_payment_received
+from traffic import format_traffic, usage_since
+
+handler_seconds = Histogram('hrvpn_handler_seconds', "aiogram handler processing time",
+                            ('handler', 'result'))
+
+
+async def handler_metrics_middleware(handler, event, data):
+    # Внутренний middleware вызывается только для сработавшего обработчика, его имя и есть метка
+    name = data['handler'].callback.__name__
+    started = time.perf_counter()
+    result = 'error'
+    # Время цикла событий, занятое обработчиком, учитывается монитором под его именем
+    token = activity.set(f'handler:{name}')
+    try:
+        response = await handler(event, data)
+        result = 'ok'
+        return response
+    finally:
+        activity.reset(token)
+        handler_seconds.observe(time.perf_counter() - started, name, result)
+
+
+router.message.middleware(handler_metrics_middleware)
+router.callback_query.middleware(handler_metrics_middleware)
+
+_bot = None
+_dispatcher = None
+
+
+def get_bot():
+    global _bot
+    if _bot is None:
+        _bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    return _bot
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        # Состояние FSM хранится в общей базе, чтобы его видели все процессы кластера
+        _dispatcher = Dispatcher(storage=SQLiteStorage())
+        _dispatcher.include_router(router)
+    return _dispatcher
 
 
 # Обработчики команд и сообщений
-@dp.message(Command("start"))
+@router.message(Command("start"))
 async def start(message: types.Message):
     user_id = message.from_user.id
     # Добавляем пользователя в таблицу users
     await add_user(user_id)
     # Проверяем, использовал ли пользователь тестовую подписку
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM test_usage WHERE user_id = ?', (user_id,))
-        row = await cursor.fetchone()
-        has_used_test = row[0] > 0
+    used_test = await has_used_test(user_id)
 
     # Формируем клавиатуру
     keyboard_buttons = [
@@ -56,7 +94,7 @@ async def start(message: types.Message):
         [InlineKeyboardButton(text="Инструкция", callback_data="instruction")],
     ]
 
-    if not has_used_test:
+    if not used_test:
         keyboard_buttons.insert(1, [InlineKeyboardButton(
             text="Тест VPN на час", callback_data="test_vpn")])
 
@@ -64,7 +102,7 @@ async def start(message: types.Message):
     await message.answer("Выберите действие:", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data == "instruction")
+@router.callback_query(F.data == "instruction")
 async def handle_instruction(callback_query: types.CallbackQuery):
     instruction_text = (
         "Для того чтобы начать пользоваться VPN, установите приложение Outline VPN:\n\n"
@@ -79,29 +117,32 @@ async def handle_instruction(callback_query: types.CallbackQuery):
     await callback_query.message.answer(instruction_text, parse_mode="Markdown", disable_web_page_preview=True)
 
 
-@dp.callback_query(F.data == "my_keys")
+@router.callback_query(F.data == "my_keys")
 async def handle_my_keys(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
+    chat_id = callback_query.message.chat.id
     subscriptions = await get_subscriptions(user_id)
     if subscriptions:
-        await callback_query.message.answer("Ваши ключи:")
+        usage = await get_traffic_usage([sub['id'] for sub in subscriptions], usage_since())
+        await send_message(chat_id, "Ваши ключи:")
         for sub in subscriptions:
             # Отправляем ключ
-            await callback_query.message.answer(sub['access_url'])
+            await send_message(chat_id, sub['access_url'])
+            await send_message(chat_id, f"Трафик за 30 дней: {format_traffic(usage.get(sub['id'], 0))}")
             # Вычисляем оставшееся время
             time_left = sub['expires_at'] - datetime.now(timezone.utc)
             total_seconds_left = time_left.total_seconds()
             if total_seconds_left > 86400:
                 days_left = int(total_seconds_left // 86400)
-                await callback_query.message.answer(f"До окончания подписки осталось {days_left} дней")
+                await send_message(chat_id, f"До окончания подписки осталось {days_left} дней")
             elif 3600 < total_seconds_left <= 86400:
                 hours_left = int(total_seconds_left // 3600)
-                await callback_query.message.answer(f"До окончания подписки осталось менее {hours_left} часов")
+                await send_message(chat_id, f"До окончания подписки осталось менее {hours_left} часов")
             elif 0 < total_seconds_left <= 3600:
                 minutes_left = int(total_seconds_left // 60)
-                await callback_query.message.answer(f"До окончания подписки осталось менее {minutes_left} минут")
+                await send_message(chat_id, f"До окончания подписки осталось менее {minutes_left} минут")
             else:
-                await callback_query.message.answer("Срок действия подписки истек")
+                await send_message(chat_id, "Срок действия подписки истек")
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(
@@ -110,8 +151,8 @@ async def handle_my_keys(callback_query: types.CallbackQuery):
                     text="Купить еще ключ", callback_data="buy_new_key")]
             ]
         )
-        await callback_query.message.answer("Чтобы продлить подписку или купить новый ключ, нажмите кнопку ниже.",
-                                            reply_markup=keyboard)
+        await send_message(chat_id, "Чтобы продлить подписку или купить новый ключ, нажмите кнопку ниже.",
+                           reply_markup=keyboard)
     else:
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -119,10 +160,10 @@ async def handle_my_keys(callback_query: types.CallbackQuery):
                     text="Оформить подписку", callback_data="buy_new_key")],
             ]
         )
-        await callback_query.message.answer("У вас нет активных подписок.", reply_markup=keyboard)
+        await send_message(chat_id, "У вас нет активных подписок.", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data == "buy_new_key")
+@router.callback_query(F.data == "buy_new_key")
 async def handle_buy_new_key(callback_query: types.CallbackQuery):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -137,7 +178,7 @@ async def handle_buy_new_key(callback_query: types.CallbackQuery):
     await callback_query.message.answer("Выберите период подписки для нового ключа:", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data == "renew_subscription")
+@router.callback_query(F.data == "renew_subscription")
 async def handle_renew_subscription(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     subscriptions = await get_subscriptions(user_id)
@@ -161,13 +202,13 @@ async def handle_renew_subscription(callback_query: types.CallbackQuery):
         await callback_query.message.answer("Выберите подписку для продления:", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data.startswith("choose_sub_"))
+@router.callback_query(F.data.startswith("choose_sub_"))
 async def handle_choose_subscription(callback_query: types.CallbackQuery):
     sub_id = int(callback_query.data.split("_")[2])
     await choose_renewal_period(callback_query.message, sub_id)
 
 
-@dp.callback_query(F.data.startswith("new_subscribe_"))
+@router.callback_query(F.data.startswith("new_subscribe_"))
 async def process_new_subscription(callback_query: types.CallbackQuery):
     period = int(callback_query.data.split("_")[2])
     amount_mapping = {30: 200, 90: 500, 180: 1000}
@@ -200,7 +241,7 @@ async def process_new_subscription(callback_query: types.CallbackQuery):
     )
 
 
-@dp.callback_query(F.data.startswith("renew_"))
+@router.callback_query(F.data.startswith("renew_"))
 async def process_renew_subscription(callback_query: types.CallbackQuery):
     parts = callback_query.data.split("_")
     if len(parts) != 3:
@@ -238,7 +279,7 @@ async def process_renew_subscription(callback_query: types.CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "pay_subscription")
+@router.callback_query(F.data == "pay_subscription")
 async def handle_pay_subscription(callback_query: types.CallbackQuery):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -251,53 +292,35 @@ async def handle_pay_subscription(callback_query: types.CallbackQuery):
     await callback_query.message.answer("Выберите действие:", reply_markup=keyboard)
 
 
-@dp.callback_query(F.data == "test_vpn")
+@router.callback_query(F.data == "test_vpn")
 async def handle_test_vpn(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
 
     # Проверяем, использовал ли пользователь тестовую подписку
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM test_usage WHERE user_id = ?', (user_id,))
-        row = await cursor.fetchone()
-        has_used_test = row[0] > 0
-
-    if has_used_test:
+    if await has_used_test(user_id):
         await callback_query.message.answer("Вы уже использовали тестовый период.")
         return
 
-    # Создаём VPN-ключ на 1 час
-    vpn_key_data = await create_vpn_key_with_name(user_id)
-    if vpn_key_data:
-        try:
-            duration_hours = 1
-            duration_days = duration_hours / 24  # Конвертируем часы в дни
-
-            # Сохраняем подписку с точным временем окончания
-            await save_subscription(user_id, vpn_key_data, duration_days)
-
-            # Добавляем запись в test_usage
-            async with aiosqlite.connect(DB_FILE) as db:
-                await db.execute('INSERT INTO test_usage (user_id, used_at) VALUES (?, ?)',
-                                 (user_id, datetime.now(timezone.utc).isoformat()))
-                await db.commit()
+    duration_hours = 1
+    duration_days = duration_hours / 24  # Конвертируем часы в дни
 
+    # Выдаём VPN-ключ на 1 час (из пула заранее созданных ключей, если он не пуст).
+    # Запись в test_usage сохраняется в одной транзакции с подпиской: при двойном нажатии
+    # второй запрос откатывается, а ключ остается в пуле или удаляется с сервера
+    try:
+        vpn_key_data = await provision_key(user_id, duration_days, trial=True)
+        if vpn_key_data:
             # Отправляем ключ пользователю
             await callback_query.message.answer("Ваш тестовый ключ:")
             await callback_query.message.answer(vpn_key_data['accessUrl'])
             await callback_query.message.answer("Ключ будет действителен в течение 1 часа.")
-
-        except Exception as e:
-            # Обработка исключений
-            logging.error(f"Ошибка при сохранении тестовой подписки: {e}")
-            # Удаляем ключ с сервера в случае ошибки
-            try:
-                manager.delete_key(vpn_key_data['id'])
-                logging.error(f"Ключ {vpn_key_data['id']} удален с сервера из-за ошибки при сохранении в базе данных")
-            except Exception as delete_exception:
-                logging.error(f"Ошибка при удалении ключа {vpn_key_data['id']}: {delete_exception}")
-            await callback_query.message.answer("Произошла ошибка при создании тестовой подписки. Попробуйте позже.")
-    else:
-        await callback_query.message.answer("Не удалось создать тестовый ключ. Попробуйте позже.")
+        else:
+            await callback_query.message.answer("Не удалось создать тестовый ключ. Попробуйте позже.")
+    except TrialAlreadyUsed:
+        await callback_query.message.answer("Вы уже использовали тестовый период.")
+    except Exception as e:
+        logging.error("Ошибка при сохранении тестовой подписки: %s", e)
+        await callback_query.message.answer("Произошла ошибка при создании тестовой подписки. Попробуйте позже.")
 
 
 async def choose_renewal_period(message: types.Message, sub_id):
@@ -337,8 +360,10 @@ def generate_payment_link(amount, label, description):
 
 
 async def yoomoney_notification(request):
+    started = time.monotonic()
     data = await request.post()
-    logging.info(f"Получено уведомление от ЮMoney: {data}")
+    # Полное уведомление содержит данные плательщика, поэтому пишется только на уровне DEBUG
+    logging.debug("Получено уведомление от ЮMoney: %s", data)
 
     # Получаем параметры из уведомления
     notification_type = data.get('notification_type', '')
@@ -350,7 +375,6 @@ async def yoomoney_notification(request):
     codepro = data.get('codepro', '')
     label = data.get('label', '')
     sha1_hash = data.get('sha1_hash', '')
-    withdraw_amount_str = data.get('withdraw_amount', '').replace(',', '.').strip()
 
     # Строка для проверки подписи
     params_list = [
@@ -372,117 +396,17 @@ async def yoomoney_notification(request):
         logging.error("Неверная подпись в уведомлении от ЮMoney")
         return web.Response(text='Invalid signature')
 
-    # Проверяем, не была ли уже обработана эта транзакция
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute('''
-            SELECT COUNT(*) FROM purchase_history WHERE operation_id = ?
-        ''', (operation_id,))
-        row = await cursor.fetchone()
-        if row[0] > 0:
-            logging.info(f"Уведомление с operation_id {operation_id} уже обработано.")
-            return web.Response(text='OK')  # Возвращаем OK, чтобы ЮMoney не отправлял повторные уведомления
-
-    # Подпись верна, обрабатываем платеж
-    if not label:
-        logging.error("Отсутствует label в уведомлении")
-        return web.Response(text='Invalid label')
-
-    # Преобразуем withdraw_amount_str в Decimal
-    try:
-        paid_amount = decimal.Decimal(withdraw_amount_str)
-        paid_amount = paid_amount.quantize(decimal.Decimal('1.00'))  # Округляем до 2 знаков
-    except decimal.InvalidOperation:
-        logging.error(f"Некорректная сумма withdraw_amount: {withdraw_amount_str}")
-        return web.Response(text='Invalid withdraw_amount')
-
-    logging.info(f"paid_amount: {paid_amount}")
-
-    # Обновляем amount_mapping с использованием Decimal
-    amount_mapping = {
-        # decimal.Decimal('5.00'): 5,
-        decimal.Decimal('200.00'): 30,
-        decimal.Decimal('500.00'): 90,
-        decimal.Decimal('1000.00'): 180
-    }
-
-    matching_amount = None
-    for amt in amount_mapping:
-        difference = abs(paid_amount - amt)
-        logging.info(f"Сравнение paid_amount: {paid_amount} и amt: {amt}, разница: {difference}")
-        if difference <= decimal.Decimal('0.01'):
-            matching_amount = amt
-            break
-
-    logging.info(f"matching_amount: {matching_amount}")
-
-    if not matching_amount:
-        logging.error(f"Не удалось найти соответствие для paid_amount: {paid_amount}")
-        # Попытка извлечь user_id для отправки сообщения
-        if label.startswith('renew_') or label.startswith('new_subscribe_'):
-            parts = label.split('_')
-            if len(parts) >= 2:
-                user_id_str = parts[1]
-                if user_id_str.isdigit():
-                    user_id = int(user_id_str)
-                    await bot.send_message(user_id, "Получена неверная сумма оплаты.")
-        return web.Response(text='Invalid amount')
-
-    expected_period = amount_mapping[matching_amount]
-
-    if label.startswith('renew_'):
-        # Обработка продления подписки
-        parts = label.split('_')
-        if len(parts) < 4:
-            logging.error(f"Некорректный формат label для продления: {label}")
-            return web.Response(text='Invalid label format for renew')
-
-        _, user_id_str, sub_id_str, _ = parts
-        if not user_id_str.isdigit() or not sub_id_str.isdigit():
-            logging.error(f"Некорректные идентификаторы в label: {label}")
-            return web.Response(text='Invalid user or sub ID in label')
-
-        user_id = int(user_id_str)
-        sub_id = int(sub_id_str)
-
-        # Продлеваем подписку
-        await extend_subscription(user_id, sub_id, expected_period)
-        # Сохраняем историю покупки с operation_id
-        await save_purchase_history(user_id, float(matching_amount), expected_period, 'renew_subscription', label,
-                                    operation_id)
-        await bot.send_message(user_id, f"Оплата получена! Ваша подписка продлена на {expected_period} дней.")
-        return web.Response(text='OK')
-
+    # Подпись верна: сохраняем уведомление во входящие и сразу отвечаем ЮMoney,
+    # ключ выдается фоновым обработчиком payments.run_payment_worker
+    if not operation_id:
+        logging.error("Отсутствует operation_id в уведомлении")
+        return web.Response(text='Invalid operation_id')
+    if await save_payment_notification(operation_id, dict(data)):
+        notify_payment_received()
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        logging.info("Уведомление с operation_id %s принято", operation_id,
+                     extra={'operation_id': operation_id, 'latency_ms': latency_ms})
     else:
-        # Обработка новых подписок
-        parts = label.split('_')
-        if len(parts) < 2:
-            logging.error(f"Некорректный формат label для новой подписки: {label}")
-            return web.Response(text='Invalid label format for new subscription')
-
-        user_id_str = parts[0]
-        if not user_id_str.isdigit():
-            logging.error(f"Некорректный user_id в label: {label}")
-            return web.Response(text='Invalid user ID in label')
-
-        user_id = int(user_id_str)
-
-        # Создаем VPN-ключ и сохраняем подписку
-        vpn_key_data = await create_vpn_key_with_name(user_id)
-        if vpn_key_data:
-            await save_subscription(user_id, vpn_key_data, expected_period)
-            # Сохраняем историю покупки с operation_id
-            await save_purchase_history(user_id, float(matching_amount), expected_period, 'new_subscription', label,
-                                        operation_id)
-            # Создаем клавиатуру с кнопкой "Инструкция"
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="Инструкция", callback_data="instruction")]
-                ]
-            )
-            # Отправляем сообщение с ключом и клавиатурой
-            await bot.send_message(user_id, f"Оплата получена! Ваш ключ:")
-            await bot.send_message(user_id, f"{vpn_key_data['accessUrl']}", reply_markup=keyboard)
-            return web.Response(text='OK')
-        else:
-            await bot.send_message(user_id, "Ошибка при создании VPN-ключа.")
-            return web.Response(text='Error creating VPN key')
+        logging.info("Уведомление с operation_id %s уже получено.", operation_id,
+                     extra={'operation_id': operation_id})
+    return web.Response(text='OK')
@@ -0,0 +1,103 @@
+# telegram_webhook.py
+import asyncio
+import logging
+import os
+import secrets
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from metrics import Gauge, add_collector
+
+TELEGRAM_MODE = os.getenv('TELEGRAM_MODE', 'polling')  # 'webhook' in production, 'polling' for local development
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')  # Public https URL that reaches TELEGRAM_WEBHOOK_PATH
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram/webhook')
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token; если не задан, создается заново при каждом запуске
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+TELEGRAM_MAX_IN_FLIGHT = int(os.getenv('TELEGRAM_MAX_IN_FLIGHT', '100'))  # Updates processed at the same time
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_MAX_CONNECTIONS', '40'))  # Parallel requests from Telegram
+TELEGRAM_SHUTDOWN_TIMEOUT = 10  # Seconds in-flight updates may finish after shutdown starts
+
+webhook_gauge = Gauge('hrvpn_telegram_webhook', "Telegram webhook updates in flight and waiting for a slot",
+                      ('stat',))
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Answers Telegram right away and processes the update in a background task.
+
+    At most max_in_flight updates run at once. When every slot is busy the request waits
+    for one before it is answered, so Telegram slows down instead of tasks piling up.
+    The bot session stays open on shutdown because the outbound queue still uses it.
+    """
+
+    def __init__(self, dispatcher, bot, secret_token, max_in_flight=TELEGRAM_MAX_IN_FLIGHT):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.waiting = 0
+
+    @property
+    def in_flight(self):
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot, update)
+        except Exception:
+            logging.exception("Ошибка при обработке обновления %s", update.get('update_id'))
+        finally:
+            self._slots.release()
+
+    async def _handle_request_background(self, bot, request):
+        update = await request.json(loads=bot.session.json_loads)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        task = asyncio.create_task(self._background_feed_update(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({})
+
+    async def close(self):
+        tasks = list(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=TELEGRAM_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning("Прервана обработка обновлений при остановке: %s", len(pending))
+
+
+def setup_telegram_webhook(app, dispatcher, bot):
+    """Mount the Telegram webhook on the aiohttp app; returns the request handler."""
+    handler = BoundedRequestHandler(dispatcher, bot, secret_token=TELEGRAM_WEBHOOK_SECRET)
+    handler.register(app, path=TELEGRAM_WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def collect_metrics():
+        webhook_gauge.set(handler.in_flight, 'in_flight')
+        webhook_gauge.set(handler.waiting, 'waiting')
+
+    add_collector(collect_metrics)
+    return handler
+
+
+async def start_webhook(dispatcher, bot):
+    if not TELEGRAM_WEBHOOK_URL:
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL is required when TELEGRAM_MODE=webhook")
+    # Обновления, пришедшие во время перезапуска, Telegram доставит после set_webhook
+    await bot.set_webhook(
+        TELEGRAM_WEBHOOK_URL,
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        max_connections=TELEGRAM_MAX_CONNECTIONS,
+    )
+    logging.info("Вебхук Telegram установлен: %s", TELEGRAM_WEBHOOK_URL)
+
+
+async def run_polling(dispatcher, bot):
+    # getUpdates не работает, пока у бота установлен вебхук
+    await bot.delete_webhook()
+    await dispatcher.start_polling(bot)
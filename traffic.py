@@ -0,0 +1,55 @@
+# traffic.py
+import asyncio
+import logging
+import os
+import time
+
+from db import compact_traffic, record_traffic
+from vpn_manager import get_manager
+
+TRAFFIC_INTERVAL = int(os.getenv('TRAFFIC_INTERVAL', '300'))  # Seconds between collections
+TRAFFIC_SAMPLES_RETENTION = 2 * 86400  # Raw deltas are kept this long after being rolled up
+TRAFFIC_HOURLY_RETENTION = 35 * 86400  # Hourly rollups are kept this long; daily ones are kept
+TRAFFIC_USAGE_PERIOD = 30 * 86400  # Period shown to users and in the admin panel, read from the hourly rollup
+
+last_collection_stats = {}
+
+
+def format_traffic(size):
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+
+def usage_since():
+    return int(time.time()) - TRAFFIC_USAGE_PERIOD
+
+
+async def collect_server_traffic(server, now_ts):
+    # Один запрос на сервер возвращает счетчики всех ключей
+    counters = await get_manager().client(server).get_transfer_metrics()
+    keys, delta = await record_traffic(server, counters, now_ts)
+    last_collection_stats[server] = {'keys': len(counters), 'active': keys, 'bytes': delta, 'collected_at': now_ts}
+    return delta
+
+
+async def collect_traffic():
+    now_ts = int(time.time())
+    servers = get_manager().names
+    results = await asyncio.gather(*(collect_server_traffic(server, now_ts) for server in servers), return_exceptions=True)
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception):
+            logging.error("Ошибка при сборе трафика с сервера %s: %s", server, result)
+    samples, hourly = await compact_traffic(now_ts - TRAFFIC_SAMPLES_RETENTION, now_ts - TRAFFIC_HOURLY_RETENTION)
+    logging.info("Трафик собран: %s, удалено старых записей: %s", last_collection_stats, samples + hourly)
+
+
+async def run_traffic_collector():
+    while True:
+        try:
+            await collect_traffic()
+        except Exception as e:
+            logging.error("Ошибка при сборе трафика: %s", e)
+        await asyncio.sleep(TRAFFIC_INTERVAL)
@@ -1,33 +1,144 @@
 # vpn_manager.py
+import asyncio
+import json
 import os
 import logging
+import time
 from datetime import datetime, timezone
-import asyncio
 
-from dotenv import load_dotenv
-from outline_vpn.outline_vpn import OutlineVPN
+from outline_client import OutlineClient, OutlineError
+from settings import CERT_SHA256, OUTLINE_API, OUTLINE_SERVERS
+
+OUTLINE_TIMEOUT = float(os.getenv('OUTLINE_TIMEOUT', '10'))  # Seconds per API call
+DEFAULT_SERVER = 'default'
+FLEET_LOAD_TTL = 300  # Seconds a server load snapshot is used for key placement
+
+
+def load_server_config():
+    if OUTLINE_SERVERS:
+        servers = json.loads(OUTLINE_SERVERS)
+    else:
+        servers = [{'name': DEFAULT_SERVER, 'api_url': OUTLINE_API, 'cert_sha256': CERT_SHA256}]
+    names = [server['name'] for server in servers]
+    if not names or len(set(names)) != len(names):
+        raise ValueError("OUTLINE_SERVERS must list servers with unique names")
+    return servers
+
+
+class OutlineFleet:
+    """A set of Outline servers addressed by name.
+
+    New keys go to the server with the lowest load, where load is the server's share of
+    all keys plus its share of the transfer bytes reported by /metrics/transfer, divided
+    by the configured weight. Every other call is routed to the server holding the key.
+    """
+
+    def __init__(self, servers, timeout=10):
+        self.clients = {
+            server['name']: OutlineClient(api_url=server['api_url'], cert_sha256=server.get('cert_sha256'),
+                                          timeout=timeout, name=server['name'])
+            for server in servers
+        }
+        self.weights = {server['name']: float(server.get('weight', 1)) for server in servers}
+        self.load = {name: {'keys': 0, 'bytes': 0, 'available': True} for name in self.clients}
+        self._load_updated = 0.0
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def names(self):
+        return list(self.clients)
+
+    def client(self, server):
+        try:
+            return self.clients[server]
+        except KeyError:
+            raise OutlineError(f"Unknown Outline server: {server}") from None
+
+    async def _refresh_server_load(self, name):
+        client = self.clients[name]
+        try:
+            keys, transfer = await asyncio.gather(client.get_keys(), client.get_transfer_metrics())
+        except OutlineError as e:
+            logging.error("Error reading load of Outline server %s: %s", name, e)
+            self.load[name]['available'] = False
+            return
+        self.load[name] = {'keys': len(keys), 'bytes': sum(transfer.values()), 'available': True}
+
+    async def refresh_load(self):
+        async with self._load_lock:
+            # Placements that waited on the lock use the figures the first of them fetched
+            if time.monotonic() - self._load_updated <= FLEET_LOAD_TTL:
+                return
+            await asyncio.gather(*(self._refresh_server_load(name) for name in self.clients))
+            self._load_updated = time.monotonic()
+        logging.info("Outline fleet load: %s", self.load)
+
+    async def pick_server(self):
+        if len(self.clients) == 1:
+            return self.names[0]
+        if time.monotonic() - self._load_updated > FLEET_LOAD_TTL:
+            await self.refresh_load()
+        candidates = [name for name in self.clients if self.load[name]['available']] or self.names
+        total_keys = sum(self.load[name]['keys'] for name in candidates) or 1
+        total_bytes = sum(self.load[name]['bytes'] for name in candidates) or 1
+        return min(candidates, key=lambda name: (
+            self.load[name]['keys'] / total_keys + self.load[name]['bytes'] / total_bytes) / self.weights[name])
+
+    async def create_key(self, name=None, server=None, timeout=None):
+        """Create a key on the given or least loaded server; the result carries its 'server'."""
+        server = server or await self.pick_server()
+        client = self.client(server)
+        # Count the key right away so concurrent creations are spread until the next refresh
+        self.load[server]['keys'] += 1
+        try:
+            key = await client.create_key(name=name, timeout=timeout)
+        except Exception:
+            self.load[server]['keys'] -= 1
+            raise
+        key['server'] = server
+        return key
+
+    async def rename_key(self, server, key_id, name, timeout=None):
+        await self.client(server).rename_key(key_id, name, timeout=timeout)
+
+    async def delete_key(self, server, key_id, timeout=None):
+        return await self.client(server).delete_key(key_id, timeout=timeout)
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+
+
+_manager = None
+
+
+def get_manager():
+    """The shared Outline API clients, one per server, created on first use."""
+    global _manager
+    if _manager is None:
+        _manager = OutlineFleet(load_server_config(), timeout=OUTLINE_TIMEOUT)
+    return _manager
 
-# Load environment variables
-load_dotenv()
 
-OUTLINE_API = os.getenv('OUTLINE_API')
-CERT_SHA256 = os.getenv('CERT_SHA256')
+async def close_manager():
+    global _manager
+    if _manager is not None:
+        await _manager.close()
+        _manager = None
 
-# Initialize the OutlineVPN manager
-manager = OutlineVPN(api_url=OUTLINE_API, cert_sha256=CERT_SHA256)
 
-async def create_vpn_key_with_name(user_id):
+async def create_vpn_key_with_name(user_id, server=None):
     try:
-        key = manager.create_key()
-        manager.rename_key(key.key_id, f"User_{user_id}_{datetime.now(timezone.utc).isoformat()}")
-        key = manager.get_key(key.key_id)
+        key = await get_manager().create_key(name=f"User_{user_id}_{datetime.now(timezone.utc).isoformat()}",
+                                             server=server)
         key_data = {
-            "id": key.key_id,
-            "name": key.name,
-            "accessUrl": key.access_url,
+            "id": key['id'],
+            "name": key['name'],
+            "accessUrl": key['accessUrl'],
+            "server": key['server'],
         }
-        logging.info(f"Key created for user {user_id}: {key_data}")
+        logging.info("Key created for user %s: %s", user_id, key_data,
+                     extra={'user_id': user_id, 'key_id': key['id'], 'server': key['server']})
         return key_data
     except Exception as e:
-        logging.error(f"Error creating VPN key: {e}")
+        logging.error("Error creating VPN key: %s", e)
         return None